@@ -8,7 +8,7 @@
 from bpy.props import *
 from mathutils import *
 from functools import reduce
-import os, os.path, errno, bpy, math
+import os, os.path, errno, bpy, math, struct, zlib, base64, hashlib, random
 
 bl_addon_info = {
   'name': 'Y.A.W.G.L.E. Export (.html)',
@@ -52,31 +52,73 @@ def _vertex_index(vertexdata, data, datamap):
     datamap[key].append((index, vertexdata))
   return index
 
-def _json_MESH(mesh):
+def _mesh_DATA(mesh, flip=False, uvmap=None, texture_of=None, weights=None, vertex_of=None):
+  if uvmap is None: uvmap = {}
+  if texture_of is None: texture_of = {}
 
   data = []
   indices = []
+  textures = []
   datamap = {}
   for face in mesh.faces:
     swizzle = [2, 1, 0] if len(face.vertices) == 3 else [ 2, 1, 0, 3, 2, 0 ]
+    if flip: swizzle.reverse()
+    image = _face_image(mesh, face)
+    textures += [texture_of.get(image, image)] * (len(swizzle) // 3)
+    # UV transform into atlas space, if the face's image was packed.
+    su, sv, ou, ov = uvmap.get(image, (1, 1, 0, 0))
     for s in swizzle:
       datum = []
       if len(mesh.uv_textures):
         for t in mesh.uv_textures:
           if t.data[face.index]:
-            datum += t.data[face.index].uv[s][0:2]
+            u, v = t.data[face.index].uv[s][0:2]
+            datum += [ou + u * su, ov + v * sv]
             break
       else: datum += [0,0]
       datum += mesh.vertices[face.vertices[s]].co[0:3]
       datum += mesh.vertices[face.vertices[s]].normal[0:3]
-      indices.append(_vertex_index(datum, data, datamap))
+      if weights: datum += weights[face.vertices[s]]
+      index = _vertex_index(datum, data, datamap)
+      # Mesh vertex of every new vertex.
+      if vertex_of is not None and index == len(vertex_of):
+        vertex_of.append(face.vertices[s])
+      indices.append(index)
+
+  indices, ranges = _draw_RANGES(indices, textures)
+  return data, indices, ranges
+
+def _draw_RANGES(indices, textures):
+  # Groups triangles by their texture, keeping their order otherwise.
+  # Returns the indices and the draw ranges as (texture, first index, index
+  # count), untextured first.
+  order = sorted(range(len(textures)), key=lambda t: (textures[t] is not None, textures[t] or ''))
+  out = []
+  ranges = []
+  for t in order:
+    if not ranges or ranges[-1][0] != textures[t]:
+      ranges.append([textures[t], len(out), 0])
+    out += indices[t * 3:t * 3 + 3]
+    ranges[-1][2] += 3
+  return out, [tuple(r) for r in ranges]
+
+def _json_MESH(mesh):
+  data, indices, ranges = _mesh_DATA(mesh)
+  return _json_DATA(data, indices, ranges)
+
+def _json_DATA(data, indices, ranges=None):
+  if ranges is None: ranges = []
 
   s = ''
 
-  # Vertices, normals, texcoords.
-  for name, positions in [
+  # Vertices, normals, texcoords and of skinned meshes bone indices and
+  # weights.
+  attributes = [
     ('texcoords', [0, 1]), ('vertices', [2, 3, 4]), ('normals', [5, 6, 7])
-  ]:
+  ]
+  if data and len(data[0]) > 8:
+    attributes += [('bones', [8, 9, 10, 11]), ('weights', [12, 13, 14, 15])]
+  for name, positions in attributes:
     first = True
     s += ',"%s":[' % (name)
     for d in data:
@@ -95,8 +137,955 @@ def _json_MESH(mesh):
     s += str(index)
   s += ']'
 
+  # Index counts of the draw ranges.
+  if len(ranges) > 1:
+    s += ',"ranges":[%s]' % (','.join([str(r[2]) for r in ranges]))
+
+  return s
+
+def _progressive_LEVELS(data, indices, ratio=0.5):
+  # Coarse to fine levels by vertex clustering on nested grids. A cell is
+  # represented by its lowest numbered vertex, so the representatives of a
+  # level include those of every coarser level. Levels stop once they keep
+  # more than ratio of the triangles, the full mesh is always the last level.
+  # Returns the new vertex order and, per level, the number of vertices it
+  # introduces, its index list in new vertex numbers and the number of the
+  # full mesh triangle each of its triangles comes from.
+  full = len(indices) // 3
+  lo = [min([d[i] for d in data]) for i in (2, 3, 4)]
+  hi = [max([d[i] for d in data]) for i in (2, 3, 4)]
+  extent = max([hi[i] - lo[i] for i in range(3)])
+  levels = []
+  divisions = 2
+  while extent > 0 and divisions <= 1024:
+    cells = {}
+    rep = []
+    for i, d in enumerate(data):
+      cell = tuple([
+        min(int((d[2+k] - lo[k]) / extent * divisions), divisions - 1)
+        for k in range(3)
+      ])
+      rep.append(cells.setdefault(cell, i))
+    tris = []
+    sources = []
+    seen = set()
+    for t in range(0, len(indices), 3):
+      a, b, c = rep[indices[t]], rep[indices[t+1]], rep[indices[t+2]]
+      if a == b or b == c or a == c: continue
+      key = tuple(sorted((a, b, c)))
+      if key in seen: continue
+      seen.add(key)
+      tris += [a, b, c]
+      sources.append(t // 3)
+    divisions *= 2
+    if len(tris) // 3 > full * ratio: break
+    if not tris or (levels and len(tris) == len(levels[-1][0])): continue
+    levels.append((tris, sources))
+  levels.append((list(indices), list(range(full))))
+
+  order = []
+  remap = {}
+  counts = []
+  for tris, sources in levels:
+    first = len(order)
+    for i in tris:
+      if i not in remap:
+        remap[i] = len(order)
+        order.append(i)
+    counts.append(len(order) - first)
+  for i in range(len(data)):
+    if i not in remap:
+      remap[i] = len(order)
+      order.append(i)
+      counts[-1] += 1
+  return order, [
+    (counts[l], [remap[i] for i in levels[l][0]], levels[l][1])
+    for l in range(len(levels))
+  ]
+
+def _pack(fmt, values):
+  return struct.pack('<%d%s' % (len(values), fmt), *values)
+
+def _binary_PROGRESSIVE(data, indices, ranges=None):
+  # Progressive mesh stream, little endian:
+  #   header: 'YPM1', vertex count, max index count, level count, flags
+  #     (uint32, flag 1 means 32 bit indices, flag 2 that a draw range count
+  #     follows)
+  #   per level: new vertex count, index count (uint32), index count of each
+  #     draw range (uint32, with flag 2), positions, normals and texcoords of
+  #     the new vertices (float32), the level's complete index list (uint16
+  #     or uint32) padded to 4 bytes.
+  if ranges is None: ranges = []
+  order, levels = _progressive_LEVELS(data, indices)
+  wide = len(data) > 65536
+  ranged = len(ranges) > 1
+  out = [struct.pack(
+    '<4sIIII', b'YPM1', len(data), max([len(l[1]) for l in levels]),
+    len(levels), (1 if wide else 0) | (2 if ranged else 0)
+  )]
+  if ranged:
+    out.append(_pack('I', [len(ranges)]))
+    # Draw range of every full mesh triangle.
+    range_of = []
+    for r, (texture, first, count) in enumerate(ranges):
+      range_of += [r] * (count // 3)
+  first = 0
+  for count, tris, sources in levels:
+    block = [data[i] for i in order[first:first+count]]
+    out.append(struct.pack('<II', count, len(tris)))
+    if ranged:
+      # Level triangles keep the full mesh order, so stay grouped by range.
+      counts = [0] * len(ranges)
+      for t in sources: counts[range_of[t]] += 3
+      out.append(_pack('I', counts))
+    out.append(_pack('f', [v for d in block for v in d[2:5]]))
+    out.append(_pack('f', [v for d in block for v in d[5:8]]))
+    out.append(_pack('f', [v for d in block for v in d[0:2]]))
+    out.append(_pack('I' if wide else 'H', tris))
+    if not wide and len(tris) % 2: out.append(b'\0\0')
+    first += count
+  return b''.join(out)
+
+def _write_MESH(jsdir, name, data, indices, ranges, progressive):
+  # Writes a mesh file, returns the loader method, the path and the scene
+  # callback that turns the loaded data into a VBO.
+  if progressive:
+    f = open(os.path.join(jsdir, '%s.bin' % (name)), 'wb')
+    f.write(_binary_PROGRESSIVE(data, indices, ranges))
+    f.close()
+    return 'loadMeshStream', 'js/%s.bin' % (name), 'streamCallback'
+  json = '{'
+  json += '"name": "%s"' % (name)
+  json += _json_DATA(data, indices, ranges)
+  json += '}\n'
+  f = open(os.path.join(jsdir, '%s.json' % (name)), 'w')
+  f.write(json)
+  f.close()
+  return 'loadJSONData', 'js/%s.json' % (name), 'vboCallback'
+
+def _face_image(mesh, face):
+  if len(mesh.uv_textures):
+    image = mesh.uv_textures[0].data[face.index].image
+    if image: return _clean_name(os.path.basename(image.filepath))
+  return None
+
+def _tiled_IMAGES(objs):
+  # Images some face samples outside [0, 1], these repeat and can not be
+  # moved into an atlas.
+  tiled = set()
+  for obj in objs:
+    mesh = obj.data
+    for face in mesh.faces:
+      image = _face_image(mesh, face)
+      if not image: continue
+      uvs = mesh.uv_textures[0].data[face.index].uv[0:len(face.vertices)]
+      for uv in uvs:
+        if min(uv[0], uv[1]) < -0.0001 or max(uv[0], uv[1]) > 1.0001:
+          tiled.add(image)
+  return tiled
+
+def _pot(n):
+  p = 1
+  while p < n: p *= 2
+  return p
+
+def _image_RGBA(img):
+  # 8 bit RGBA pixels of a Blender image, top row first.
+  w, h = img.size[0], img.size[1]
+  pixels = img.pixels[:]
+  rgba = bytearray(w * h * 4)
+  for y in range(h):
+    row = pixels[(h - 1 - y) * w * 4:(h - y) * w * 4]
+    rgba[y * w * 4:(y + 1) * w * 4] = bytes([
+      min(255, max(0, int(v * 255 + 0.5))) for v in row
+    ])
+  return w, h, rgba
+
+def _write_PNG(path, w, h, rgba):
+  raw = b''.join([
+    b'\0' + bytes(rgba[y * w * 4:(y + 1) * w * 4]) for y in range(h)
+  ])
+  def chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+  f = open(path, 'wb')
+  f.write(b'\x89PNG\r\n\x1a\n')
+  f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)))
+  f.write(chunk(b'IDAT', zlib.compress(raw, 9)))
+  f.write(chunk(b'IEND', b''))
+  f.close()
+
+def _shelf_INSERT(bin, w, h, size):
+  for shelf in bin['shelves']:
+    y, height, x = shelf
+    if h <= height and x + w <= size:
+      shelf[2] += w
+      return x, y
+  if bin['bottom'] + h <= size:
+    y = bin['bottom']
+    bin['shelves'].append([y, h, w])
+    bin['bottom'] += h
+    return 0, y
+  return None
+
+def _pack_RECTS(rects, size):
+  # Shelf packs (key, w, h) rectangles, tallest first, into as many size x
+  # size bins as needed. Returns the bins' {key: (x, y)} placements.
+  bins = []
+  for key, w, h in sorted(rects, key=lambda r: (-r[2], -r[1], r[0])):
+    pos = None
+    for bin in bins:
+      pos = _shelf_INSERT(bin, w, h, size)
+      if pos: break
+    if not pos:
+      bin = { 'shelves': [], 'bottom': 0, 'placed': {} }
+      bins.append(bin)
+      pos = _shelf_INSERT(bin, w, h, size)
+    bin['placed'][key] = (pos, w, h)
+  return [bin['placed'] for bin in bins]
+
+def _blit(dest, dw, src, w, h, x, y, padding):
+  # Copies src into dest at x, y surrounded by padding pixels of repeated
+  # edge, so filtering near the border never picks up a neighbour.
+  for row in range(-padding, h + padding):
+    sy = min(max(row, 0), h - 1)
+    line = src[sy * w * 4:(sy + 1) * w * 4]
+    line = line[0:4] * padding + line + line[-4:] * padding
+    at = ((y + padding + row) * dw + x) * 4
+    dest[at:at + len(line)] = line
+
+def _build_ATLASES(images, size, padding):
+  # Packs (imgid, img) images into size x size atlases. Returns the atlases
+  # as (atlasid, file, width, height, member imgids, RGBA pixels) and the UV
+  # transforms (scale u, scale v, offset u, offset v) into atlas space by
+  # member imgid.
+  lookup = dict(images)
+  rects = []
+  for imgid, img in images:
+    w, h = img.size[0] + 2 * padding, img.size[1] + 2 * padding
+    if w <= size and h <= size: rects.append((imgid, w, h))
+  atlases = []
+  uvmap = {}
+  for placed in _pack_RECTS(rects, size):
+    if len(placed) < 2: continue
+    aw = _pot(max([x + w for (x, y), w, h in placed.values()]))
+    ah = _pot(max([y + h for (x, y), w, h in placed.values()]))
+    # Opaque background, so atlases of opaque images compress as opaque.
+    pixels = bytearray(b'\0\0\0\xff' * (aw * ah))
+    members = sorted(placed)
+    for imgid in members:
+      (x, y), pw, ph = placed[imgid]
+      w, h, rgba = _image_RGBA(lookup[imgid])
+      _blit(pixels, aw, rgba, w, h, x, y, padding)
+      uvmap[imgid] = (
+        float(w) / aw, float(h) / ah,
+        float(x + padding) / aw, 1.0 - float(y + padding + h) / ah
+      )
+    file = 'atlas_%d.png' % len(atlases)
+    atlases.append((_clean_name(file), file, aw, ah, members, pixels))
+  return atlases, uvmap
+
+def _pot_size(n, maxsize):
+  # Nearest power of two to n, no larger than maxsize rounded down to one.
+  p = _pot(n)
+  if p - n > n - p // 2: p //= 2
+  return max(1, min(p, _pot(maxsize + 1) // 2))
+
+def _halve(w, h, rgba):
+  # 2x2 box filter, sides of 1 are kept.
+  nw, nh = max(1, w // 2), max(1, h // 2)
+  out = bytearray(nw * nh * 4)
+  for y in range(nh):
+    r0 = min(2 * y, h - 1) * w
+    r1 = min(2 * y + 1, h - 1) * w
+    for x in range(nw):
+      x0, x1 = min(2 * x, w - 1), min(2 * x + 1, w - 1)
+      a, b, c, d = (r0 + x0) * 4, (r0 + x1) * 4, (r1 + x0) * 4, (r1 + x1) * 4
+      at = (y * nw + x) * 4
+      for ch in range(4):
+        out[at + ch] = (rgba[a + ch] + rgba[b + ch] + rgba[c + ch] + rgba[d + ch] + 2) // 4
+  return nw, nh, out
+
+def _resample(w, h, rgba, nw, nh):
+  # Box filters down by halves while possible, then bilinear to nw x nh.
+  while w >= nw * 2 and h >= nh * 2:
+    w, h, rgba = _halve(w, h, rgba)
+  if w == nw and h == nh: return rgba
+  out = bytearray(nw * nh * 4)
+  for y in range(nh):
+    fy = min(max((y + 0.5) * h / nh - 0.5, 0), h - 1)
+    y0 = int(fy)
+    y1, ty = min(y0 + 1, h - 1), fy - y0
+    for x in range(nw):
+      fx = min(max((x + 0.5) * w / nw - 0.5, 0), w - 1)
+      x0 = int(fx)
+      x1, tx = min(x0 + 1, w - 1), fx - x0
+      a, b = (y0 * w + x0) * 4, (y0 * w + x1) * 4
+      c, d = (y1 * w + x0) * 4, (y1 * w + x1) * 4
+      at = (y * nw + x) * 4
+      for ch in range(4):
+        top = rgba[a + ch] * (1 - tx) + rgba[b + ch] * tx
+        bottom = rgba[c + ch] * (1 - tx) + rgba[d + ch] * tx
+        out[at + ch] = int(top * (1 - ty) + bottom * ty + 0.5)
+  return out
+
+def _mip_LEVELS(w, h, rgba, maxsize):
+  # Resamples to power of two sides no larger than maxsize, returns the mip
+  # chain down to 1x1 as (width, height, pixels) levels.
+  lw, lh = _pot_size(w, maxsize), _pot_size(h, maxsize)
+  levels = [(lw, lh, _resample(w, h, rgba, lw, lh))]
+  while lw > 1 or lh > 1:
+    lw, lh, pixels = _halve(lw, lh, levels[-1][2])
+    levels.append((lw, lh, pixels))
+  return levels
+
+def _mip_STRIP(levels):
+  # Lays mip levels out left to right in one image, top aligned. Returns the
+  # strip width and pixels.
+  sw = sum([level[0] for level in levels])
+  sh = levels[0][1]
+  strip = bytearray(sw * sh * 4)
+  x = 0
+  for lw, lh, pixels in levels:
+    for y in range(lh):
+      strip[(y * sw + x) * 4:(y * sw + x + lw) * 4] = pixels[y * lw * 4:(y + 1) * lw * 4]
+    x += lw
+  return sw, strip
+
+def _json_PLACEHOLDER(w, h, rgba, levels=None, size=8):
+  # Texture callback argument for a thumbnail no larger than size x size,
+  # taken from the mip chain when there is one.
+  if levels:
+    w, h, pixels = [level for level in levels if max(level[0], level[1]) <= size][0]
+  else:
+    scale = min(1.0, float(size) / max(w, h))
+    tw, th = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+    pixels = _resample(w, h, rgba, tw, th)
+    w, h = tw, th
+  return '{ "width": %d, "height": %d, "pixels": "%s" }' % (
+    w, h, base64.b64encode(bytes(pixels)).decode('ascii')
+  )
+
+def _rgb565(c):
+  return (
+    ((c[0] * 31 + 127) // 255) << 11 | ((c[1] * 63 + 127) // 255) << 5 |
+    (c[2] * 31 + 127) // 255
+  )
+
+def _rgb888(v):
+  r, g, b = (v >> 11) & 31, (v >> 5) & 63, v & 31
+  return ((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2))
+
+def _dxt1_BLOCK(block):
+  # Endpoints are the corners of the block's colour bounding box, along the
+  # diagonal following how green and blue vary with red.
+  n = float(len(block))
+  mean = [sum([p[c] for p in block]) / n for c in range(3)]
+  lo = [min([p[c] for p in block]) for c in range(3)]
+  hi = [max([p[c] for p in block]) for c in range(3)]
+  for c in (1, 2):
+    if sum([(p[0] - mean[0]) * (p[c] - mean[c]) for p in block]) < 0:
+      lo[c], hi[c] = hi[c], lo[c]
+  c0, c1 = _rgb565(hi), _rgb565(lo)
+  # c0 > c1 selects the four colour mode.
+  if c0 < c1: c0, c1 = c1, c0
+  if c0 == c1: return struct.pack('<HHI', c0, c1, 0)
+  e0, e1 = _rgb888(c0), _rgb888(c1)
+  palette = [e0, e1,
+    [(2 * e0[c] + e1[c]) // 3 for c in range(3)],
+    [(e0[c] + 2 * e1[c]) // 3 for c in range(3)]]
+  bits = 0
+  for i, p in enumerate(block):
+    errors = [sum([(e[c] - p[c]) ** 2 for c in range(3)]) for e in palette]
+    bits |= errors.index(min(errors)) << (2 * i)
+  return struct.pack('<HHI', c0, c1, bits)
+
+def _dxt5_BLOCK(block):
+  # Interpolated alpha block followed by a DXT1 colour block.
+  a0 = max([p[3] for p in block])
+  a1 = min([p[3] for p in block])
+  bits = 0
+  if a0 > a1:
+    palette = [a0, a1] + [((7 - k) * a0 + k * a1) // 7 for k in range(1, 7)]
+    for i, p in enumerate(block):
+      errors = [abs(a - p[3]) for a in palette]
+      bits |= errors.index(min(errors)) << (3 * i)
+  return bytes([a0, a1]) + struct.pack('<Q', bits)[0:6] + _dxt1_BLOCK(block)
+
+_ETC1_TABLES = [
+  (2, 8), (5, 17), (9, 29), (13, 42), (18, 60), (24, 80), (33, 106), (47, 183)
+]
+
+def _etc1_SUBBLOCK(pixels, base):
+  # Best modifier table for pixels around base, returns the error, table and
+  # per pixel modifier indices.
+  best = None
+  for table, (small, large) in enumerate(_ETC1_TABLES):
+    colors = [
+      [min(255, max(0, b + m)) for b in base]
+      for m in (small, large, -small, -large)
+    ]
+    error = 0
+    indices = []
+    for p in pixels:
+      errors = [sum([(e[c] - p[c]) ** 2 for c in range(3)]) for e in colors]
+      error += min(errors)
+      indices.append(errors.index(min(errors)))
+    if best is None or error < best[0]: best = (error, table, indices)
+  return best
+
+def _etc1_BLOCK(block):
+  # Tries both sub block splits, with differential base colours when the
+  # halves are close enough and individual ones otherwise.
+  best = None
+  for flip in (0, 1):
+    halves = ([], [])
+    for i in range(16):
+      halves[(i // 4 if flip else i % 4) >= 2].append(i)
+    means = [[sum([block[i][c] for i in half]) / 8.0 for c in range(3)] for half in halves]
+    q = [[int(round(v * 31 / 255.0)) for v in mean] for mean in means]
+    deltas = [q[1][c] - q[0][c] for c in range(3)]
+    if min(deltas) >= -4 and max(deltas) <= 3:
+      diff = 1
+      bases = [[(v << 3) | (v >> 2) for v in base] for base in q]
+      word = (
+        q[0][0] << 59 | (deltas[0] & 7) << 56 | q[0][1] << 51 |
+        (deltas[1] & 7) << 48 | q[0][2] << 43 | (deltas[2] & 7) << 40
+      )
+    else:
+      diff = 0
+      q = [[int(round(v * 15 / 255.0)) for v in mean] for mean in means]
+      bases = [[v * 17 for v in base] for base in q]
+      word = (
+        q[0][0] << 60 | q[1][0] << 56 | q[0][1] << 52 |
+        q[1][1] << 48 | q[0][2] << 44 | q[1][2] << 40
+      )
+    fits = [_etc1_SUBBLOCK([block[i] for i in halves[s]], bases[s]) for s in (0, 1)]
+    error = fits[0][0] + fits[1][0]
+    if best and error >= best[0]: continue
+    word |= fits[0][1] << 37 | fits[1][1] << 34 | diff << 33 | flip << 32
+    for s in (0, 1):
+      for i, k in zip(halves[s], fits[s][2]):
+        # Pixel indices are stored column major, high bits first.
+        bit = (i % 4) * 4 + i // 4
+        word |= (k >> 1) << (16 + bit) | (k & 1) << bit
+    best = (error, word)
+  return struct.pack('>Q', best[1])
+
+# Compressed texture formats by the names the renderer knows them by: the
+# file suffix, GL internal format and block encoder, for opaque and for
+# translucent textures. ETC1 has no alpha.
+_TEXTURE_FORMATS = [
+  ('dxt', ('dxt1', 0x83F0, _dxt1_BLOCK), ('dxt5', 0x83F3, _dxt5_BLOCK)),
+  ('etc1', ('etc1', 0x8D64, _etc1_BLOCK), None),
+]
+
+def _compress_LEVEL(w, h, rgba, encoder):
+  # Encodes 4x4 blocks left to right, top to bottom, repeating edge texels
+  # of levels smaller than a block.
+  out = []
+  for by in range(0, h, 4):
+    for bx in range(0, w, 4):
+      block = []
+      for y in range(4):
+        row = min(by + y, h - 1) * w
+        for x in range(4):
+          at = (row + min(bx + x, w - 1)) * 4
+          block.append(tuple(rgba[at:at + 4]))
+      out.append(encoder(block))
+  return b''.join(out)
+
+def _binary_COMPRESSED(levels, glformat, encoder):
+  # Compressed texture, little endian:
+  #   header: 'YCT1', GL internal format, width, height, level count (uint32)
+  #   per level: byte length (uint32) and the level's blocks.
+  out = [b'YCT1' + _pack('I', [glformat, levels[0][0], levels[0][1], len(levels)])]
+  for w, h, rgba in levels:
+    blocks = _compress_LEVEL(w, h, rgba, encoder)
+    out.append(_pack('I', [len(blocks)]))
+    out.append(blocks)
+  return b''.join(out)
+
+def _mesh_image(mesh):
+  if len(mesh.uv_textures) and len(mesh.uv_textures[0].data):
+    image = mesh.uv_textures[0].data[0].image
+    if image: return _clean_name(os.path.basename(image.filepath))
+  return None
+
+def _file_digest(path):
+  f = open(path, 'rb')
+  digest = hashlib.sha1(f.read()).hexdigest()
+  f.close()
+  return digest
+
+def _mesh_digest(data, indices, ranges):
+  sha = hashlib.sha1()
+  for datum in data:
+    sha.update(_pack('f', datum))
+  sha.update(_pack('I', indices))
+  sha.update(repr(ranges).encode('utf-8'))
+  return sha.hexdigest()
+
+def _json_string(s):
+  if s is None: return 'null'
+  return '"%s"' % (s)
+
+# Eye position of the renderer's default camera.
+_DEFAULT_EYE = (0.0, -5.0, 4.0)
+
+def _object_bounds(obj):
+  # Rough world space bounding sphere, ignores rotation and parenting.
+  corners = [Vector(c) for c in obj.bound_box]
+  center = Vector((0, 0, 0))
+  for c in corners: center = center + c
+  center = [center[i] / len(corners) for i in range(3)]
+  radius = max([(Vector(c) - Vector(center)).length for c in corners])
+  scale = max([abs(s) for s in obj.scale])
+  center = [obj.location[i] + center[i] * obj.scale[i] for i in range(3)]
+  return center, radius * scale
+
+def _data_BOX(data):
+  # Axis aligned bounding box of the vertices, min corner then max corner.
+  return (
+    [min([d[i] for d in data]) for i in (2, 3, 4)] +
+    [max([d[i] for d in data]) for i in (2, 3, 4)]
+  )
+
+def _data_bounds(data):
+  box = _data_BOX(data)
+  lo, hi = box[:3], box[3:]
+  center = [(lo[i] + hi[i]) / 2.0 for i in range(3)]
+  return center, (Vector(hi) - Vector(lo)).length / 2.0
+
+def _instances_BOX(box, objs):
+  # World space box around the instances of a mesh with the given box.
+  corners = [
+    Vector((x, y, z))
+    for x in (box[0], box[3]) for y in (box[1], box[4]) for z in (box[2], box[5])
+  ]
+  points = [obj.matrix_world * c for obj in objs for c in corners]
+  return (
+    [min([p[i] for p in points]) for i in range(3)] +
+    [max([p[i] for p in points]) for i in range(3)]
+  )
+
+def _json_BOX(box):
+  return '"bounds": [%s]' % (','.join([_formatnum(v) for v in box]))
+
+def _screen_size(center, radius):
+  # Estimated size on screen from the default camera, used as a download
+  # priority: larger and closer objects load first.
+  distance = (Vector(center) - Vector(_DEFAULT_EYE)).length
+  return radius / max(distance, radius, 0.000001)
+
+def _has_action(obj):
+  return bool(obj.animation_data and obj.animation_data.action)
+
+def _is_animated(obj):
+  while obj:
+    if _has_action(obj): return True
+    obj = obj.parent
+  return False
+
+def _json_TRANSFORM(obj):
+  # Translate, rotate and scale relative to the parent, if any.
+  s = '"translate": [%f, %f, %f],\n' % (
+    obj.location[0],
+    obj.location[1],
+    obj.location[2]
+  )
+  s += '    "rotate": [%f, %f, %f],\n' % (
+    math.degrees(obj.rotation_euler[0]),
+    math.degrees(obj.rotation_euler[1]),
+    math.degrees(obj.rotation_euler[2])
+  )
+  s += '    "scale": [%f, %f, %f]' % (obj.scale[0], obj.scale[1], obj.scale[2])
+  if obj.parent:
+    s += ',\n    "parent": "%s"' % (_clean_name(obj.parent.name))
+    # Column major, like the renderer's matrices.
+    m = obj.matrix_parent_inverse
+    values = [_formatnum(m[r][c]) for c in range(4) for r in range(4)]
+    if values != [_formatnum(float(r == c)) for c in range(4) for r in range(4)]:
+      s += ',\n    "parent inverse": [%s]' % (','.join(values))
   return s
 
+# Bones a skinned mesh may have, the skinning vertex shader holds three
+# uniform vectors per bone.
+_MAX_BONES = 32
+
+def _armature(obj):
+  # Armature deforming obj, through a modifier or as its parent.
+  for modifier in obj.modifiers:
+    if modifier.type == 'ARMATURE' and modifier.object: return modifier.object
+  if obj.parent and obj.parent.type == 'ARMATURE' and obj.parent_type == 'ARMATURE':
+    return obj.parent
+  return None
+
+def _bone_ORDER(armature):
+  # Bones of armature, parents before their children.
+  bones = [bone for bone in armature.data.bones if not bone.parent]
+  i = 0
+  while i < len(bones):
+    bones += list(bones[i].children)
+    i += 1
+  return bones
+
+def _skin_MESH(obj, armature, bones):
+  # Evaluates obj in the armature's rest pose. Returns the mesh and per
+  # vertex the indices of its four most influential bones and their weights
+  # as bytes summing to 255. Vertices without weights get all weights 0,
+  # the shader leaves them in place like Blender does.
+  scene = bpy.context.scene
+  position = armature.data.pose_position
+  armature.data.pose_position = 'REST'
+  scene.update()
+  mesh = obj.create_mesh(scene, True, 'PREVIEW')
+  armature.data.pose_position = position
+  scene.update()
+  index = dict([(bone.name, b) for b, bone in enumerate(bones)])
+  names = [group.name for group in obj.vertex_groups]
+  weights = []
+  for v in mesh.vertices:
+    groups = [
+      (g.weight, index[names[g.group]]) for g in v.groups
+      if g.group < len(names) and names[g.group] in index and g.weight > 0
+    ]
+    groups.sort(reverse=True)
+    groups = groups[0:4]
+    if not groups:
+      weights.append([0] * 8)
+      continue
+    total = sum([w for w, b in groups])
+    quantized = [int(round(w / total * 255)) for w, b in groups]
+    quantized[0] += 255 - sum(quantized)
+    pad = [0] * (4 - len(groups))
+    weights.append([b for w, b in groups] + pad + quantized + pad)
+  return mesh, weights
+
+def _data_KEY(obj, skins):
+  # Name obj's evaluated mesh is kept under, with the armature's name for
+  # skinned objects since their bone weights depend on it.
+  if obj.name in skins: return '%s__%s' % (obj.data.name, skins[obj.name][0].name)
+  return obj.data.name
+
+def _matrix_ROWS(m):
+  return [m[r][c] for r in range(3) for c in range(4)]
+
+def _bone_POSE(obj, armature, bones):
+  # Posed bone matrices relative to their parent bone, root bones relative to
+  # obj's space, as their top three rows.
+  offset = obj.matrix_world.inverted() * armature.matrix_world
+  values = []
+  for bone in bones:
+    pose = armature.pose.bones[bone.name]
+    if pose.parent: values += _matrix_ROWS(pose.parent.matrix.inverted() * pose.matrix)
+    else: values += _matrix_ROWS(offset * pose.matrix)
+  return values
+
+def _json_SKELETON(obj, armature, bones):
+  # Bone parents (-1 for roots), posed matrices and the inverse bind matrices
+  # taking obj's rest pose vertices into bone space.
+  bind = armature.matrix_world.inverted() * obj.matrix_world
+  inverse = []
+  for bone in bones:
+    inverse += _matrix_ROWS(bone.matrix_local.inverted() * bind)
+  return '{ "parents": [%s], "pose": [%s], "inverse bind": [%s] }' % (
+    ', '.join([str(bones.index(b.parent) if b.parent else -1) for b in bones]),
+    ','.join([_formatnum(v) for v in _bone_POSE(obj, armature, bones)]),
+    ','.join([_formatnum(v) for v in inverse])
+  )
+
+def _shape_KEYS(obj):
+  # Shape keys of obj's mesh after the basis key.
+  key = obj.data.shape_keys
+  if not key: return []
+  # Blender 2.62 renamed keys to key_blocks.
+  blocks = getattr(key, 'key_blocks', None) or key.keys
+  return list(blocks)[1:]
+
+def _keys_animated(obj):
+  key = obj.data.shape_keys
+  return bool(key and key.animation_data and key.animation_data.action)
+
+def _morph_TARGETS(evaluate, keys):
+  # Evaluates the mesh with only one shape key fully applied at a time.
+  # Returns the basis mesh and per key the vertex positions and normals, or
+  # the mesh in its current shape key pose and None if the evaluated
+  # vertices don't match the basis ones.
+  scene = bpy.context.scene
+  values = [key.value for key in keys]
+  for key in keys: key.value = 0.0
+  scene.update()
+  basis = evaluate()
+  targets = []
+  for key in keys:
+    key.value = 1.0
+    scene.update()
+    mesh = evaluate()
+    if len(mesh.vertices) == len(basis.vertices):
+      targets.append((
+        [v.co[0:3] for v in mesh.vertices], [v.normal[0:3] for v in mesh.vertices]
+      ))
+    bpy.data.meshes.remove(mesh)
+    key.value = 0.0
+  for key, value in zip(keys, values): key.value = value
+  scene.update()
+  if len(targets) < len(keys):
+    bpy.data.meshes.remove(basis)
+    return evaluate(), None
+  return basis, targets
+
+def _binary_MORPHS(data, vertex_of, targets):
+  # Sparse morph targets, little endian:
+  #   header: 'YMT1', target count, vertex index size (uint16, 2 or 4)
+  #   per target: vertex count (uint32), position and normal delta steps
+  #     (float32), vertex indices, quantized position deltas (int16 x y z)
+  #     and normal deltas (int8 x y z), each padded to 4 bytes.
+  # Only vertices a target moves are listed, in ascending order.
+  wide = len(data) > 65536
+  out = [struct.pack('<4sHH', b'YMT1', len(targets), 4 if wide else 2)]
+  for positions, normals in targets:
+    deltas = []
+    for i, datum in enumerate(data):
+      v = vertex_of[i]
+      deltas.append(
+        [positions[v][c] - datum[2 + c] for c in range(3)] +
+        [normals[v][c] - datum[5 + c] for c in range(3)]
+      )
+    pstep = max([abs(d) for delta in deltas for d in delta[0:3]] + [0]) / 32767.0
+    nstep = max([abs(d) for delta in deltas for d in delta[3:6]] + [0]) / 127.0
+    moved = []
+    for i, delta in enumerate(deltas):
+      p = [int(round(d / pstep)) if pstep else 0 for d in delta[0:3]]
+      n = [int(round(d / nstep)) if nstep else 0 for d in delta[3:6]]
+      if p != [0, 0, 0] or n != [0, 0, 0]: moved.append((i, p, n))
+    out.append(struct.pack('<Iff', len(moved), pstep, nstep))
+    for fmt, size, values in (
+      ('I' if wide else 'H', 4 if wide else 2, [i for i, p, n in moved]),
+      ('h', 2, [c for i, p, n in moved for c in p]),
+      ('b', 1, [c for i, p, n in moved for c in n])
+    ):
+      out.append(_pack(fmt, values))
+      out.append(b'\0' * (-len(values) * size % 4))
+  return b''.join(out)
+
+def _batch_MESHES(objs, uvmap=None, texture_of=None, limit=65536, members=None):
+  # Merges objects into world space batches of at most limit vertices, so
+  # every batch can be drawn with 16 bit indices. Objects over the limit on
+  # their own are left out. Returns the batches as (data, indices, draw
+  # ranges), the objects of each batch are appended to members if given.
+  if uvmap is None: uvmap = {}
+  if texture_of is None: texture_of = {}
+  chunks = []
+  data, indices, textures = [], [], []
+  batch = []
+  for obj in objs:
+    mesh = obj.create_mesh(bpy.context.scene, True, 'PREVIEW')
+    mesh.transform(obj.matrix_world)
+    mesh.calc_normals()
+    odata, oindices, oranges = _mesh_DATA(
+      mesh, obj.matrix_world.determinant() < 0, uvmap, texture_of
+    )
+    bpy.data.meshes.remove(mesh)
+    if len(odata) > limit: continue
+    if len(data) and len(data) + len(odata) > limit:
+      chunks.append((data,) + _draw_RANGES(indices, textures))
+      if members is not None: members.append(batch)
+      data, indices, textures, batch = [], [], [], []
+    batch.append(obj)
+    base = len(data)
+    data += odata
+    indices += [i + base for i in oindices]
+    for texture, first, count in oranges:
+      textures += [texture] * (count // 3)
+  if len(data):
+    chunks.append((data,) + _draw_RANGES(indices, textures))
+    if members is not None: members.append(batch)
+  return chunks
+
+def _json_TEXTURES(ranges):
+  # Texture of a mesh, or with several draw ranges the texture of each.
+  if len(ranges) > 1:
+    return '"texture image": null,\n    "range textures": [%s]' % (
+      ', '.join([_json_string(r[0]) for r in ranges])
+    )
+  return '"texture image": %s' % _json_string(ranges and ranges[0][0] or None)
+
+# Largest error keyframe reduction may introduce in translate, rotate (in
+# degrees) and scale channels. Bone matrix elements use the last one.
+_ANIMATION_TOLERANCE = [0.0005] * 3 + [0.05] * 3 + [0.0005] * 3
+
+def _sample_TRACKS(objs, scene, skins=None, morphs=None):
+  # Samples the translate, rotate (in degrees) and scale channels of objs at
+  # every frame of the scene's frame range, followed by the shape key values
+  # of objects with morph targets and the bone matrices of skinned objects.
+  if skins is None: skins = {}
+  if morphs is None: morphs = {}
+  samples = [[] for obj in objs]
+  current = scene.frame_current
+  for frame in range(scene.frame_start, scene.frame_end + 1):
+    scene.frame_set(frame)
+    for o, obj in enumerate(objs):
+      values = list(obj.location[0:3])
+      values += [math.degrees(r) for r in obj.rotation_euler[0:3]]
+      values += list(obj.scale[0:3])
+      if obj.type == 'MESH' and _data_KEY(obj, skins) in morphs:
+        values += [key.value for key in _shape_KEYS(obj)]
+      if obj.name in skins: values += _bone_POSE(obj, *skins[obj.name])
+      if not samples[o]: samples[o] = [[] for v in values]
+      for c in range(len(values)): samples[o][c].append(values[c])
+  scene.frame_set(current)
+  return samples
+
+def _fits(values, a, b, tolerance):
+  for k in range(a + 1, b):
+    value = values[a] + (values[b] - values[a]) * (k - a) / float(b - a)
+    if abs(value - values[k]) > tolerance: return False
+  return True
+
+def _reduce_KEYS(values, tolerance):
+  # Frames to keep so that linear interpolation between them reproduces
+  # every sample within tolerance.
+  keys = [0]
+  last = len(values) - 1
+  while keys[-1] < last:
+    j = keys[-1] + 1
+    while j < last and _fits(values, keys[-1], j + 1, tolerance): j += 1
+    keys.append(j)
+  return keys
+
+def _binary_ANIMATION(samples, fps):
+  # Baked animation, little endian:
+  #   header: 'YAN1', frames per second (float32), frame count, track count
+  #     (uint32)
+  #   per track: object index, channel (uint16, translate, rotate in degrees
+  #     and scale x y z, then shape key values of objects with morph targets
+  #     and bone matrix elements bone * 12 + row * 4 + column of skinned
+  #     objects), key count (uint32), minimum and step of the
+  #     quantized values (float32), key frames and quantized key values
+  #     (uint16 each, padded to 4 bytes).
+  # Channels that don't change are left out. Returns None without tracks.
+  tracks = []
+  frames = 0
+  for o, channels in enumerate(samples):
+    for c, values in enumerate(channels):
+      frames = len(values)
+      tolerance = _ANIMATION_TOLERANCE[min(c, 8)]
+      if max(values) - min(values) <= tolerance: continue
+      keys = _reduce_KEYS(values, tolerance)
+      lo = min([values[k] for k in keys])
+      step = (max([values[k] for k in keys]) - lo) / 65535.0
+      # The kept keys can all be equal when the samples between them only
+      # wobble within tolerance, the track is then constant.
+      quantized = [int(round((values[k] - lo) / step)) if step else 0 for k in keys]
+      track = [struct.pack('<HHIff', o, c, len(keys), lo, step)]
+      for array in (keys, quantized):
+        track.append(_pack('H', array))
+        if len(array) % 2: track.append(b'\0\0')
+      tracks.append(b''.join(track))
+  if not tracks: return None
+  return b''.join([struct.pack('<4sfII', b'YAN1', fps, frames, len(tracks))] + tracks)
+
+def _json_WEIGHTS(obj):
+  return ','.join([_formatnum(key.value) for key in _shape_KEYS(obj)])
+
+def _json_INSTANCES(objs):
+  values = []
+  for obj in objs:
+    values += obj.location[0:3]
+    values += [math.degrees(r) for r in obj.rotation_euler[0:3]]
+    values += obj.scale[0:3]
+  return ','.join([_formatnum(v) for v in values])
+
+def _world_BOX(objs):
+  # World space bounding box of the objects, min corner then max corner.
+  points = [obj.matrix_world * Vector(c) for obj in objs for c in obj.bound_box]
+  return (
+    [min([p[i] for p in points]) for i in range(3)] +
+    [max([p[i] for p in points]) for i in range(3)]
+  )
+
+# Objects a visibility ray passes through before giving up.
+_VISIBILITY_HOPS = 8
+
+def _first_HIT(scene, start, direction, length, index_of):
+  # Index of the first object in index_of hit by the ray, it passes through
+  # other objects since they may move.
+  for hop in range(_VISIBILITY_HOPS):
+    hit, obj, matrix, location, normal = scene.ray_cast(start, start + direction * length)
+    if not hit: return None
+    if obj.name in index_of: return index_of[obj.name]
+    length -= (location - start).length + 0.001
+    if length <= 0: return None
+    start = location + direction * 0.001
+  return None
+
+def _visibility_SETS(scene, boxes, index_of, origin, size, dims, samples):
+  # Potentially visible sets of the view cells of a grid, x fastest, by ray
+  # sampling from random points in each cell: half of the rays in random
+  # directions, half towards random points in the boxes so that small
+  # objects are found too. A cell sees the objects first hit by its rays
+  # and those whose box it overlaps. Cells none of whose rays hit anything
+  # get None.
+  rng = random.Random(0)
+  far = (Vector(origin) - Vector([origin[i] + size * dims[i] for i in range(3)])).length
+  far = max([far] + [(Vector(b[3:]) - Vector(b[:3])).length for b in boxes])
+  sets = []
+  for z in range(dims[2]):
+    for y in range(dims[1]):
+      for x in range(dims[0]):
+        lo = [origin[0] + x * size, origin[1] + y * size, origin[2] + z * size]
+        visible = set([
+          i for i, b in enumerate(boxes)
+          if all([b[j] <= lo[j] + size and b[j + 3] >= lo[j] for j in range(3)])
+        ])
+        hits = 0
+        for n in range(samples):
+          start = Vector([lo[j] + rng.random() * size for j in range(3)])
+          if n % 2:
+            b = boxes[rng.randrange(len(boxes))]
+            target = Vector([b[j] + rng.random() * (b[j + 3] - b[j]) for j in range(3)])
+            direction = target - start
+          else:
+            direction = Vector([rng.gauss(0, 1) for j in range(3)])
+          if direction.length < 0.000001: continue
+          direction.normalize()
+          i = _first_HIT(scene, start, direction, far * 2, index_of)
+          if i is None: continue
+          visible.add(i)
+          hits += 1
+        sets.append(visible if hits else None)
+  return sets
+
+def _binary_VISIBILITY(count, origin, size, dims, sets):
+  # Potentially visible sets, little endian:
+  #   header: 'YPV1', object count, set count (uint32), grid origin x y z
+  #     and cell size (float32), cells along x y z (uint16), padding
+  #   per cell, x fastest: its set (uint16, 0xffff for none)
+  #   padding to 4 bytes, then the sets as bitsets of (count + 7) / 8 bytes,
+  #     bit i & 7 of byte i >> 3 for object i.
+  # Cells seeing the same objects share a set.
+  rows = []
+  row_of = {}
+  cells = []
+  for visible in sets:
+    if visible is None:
+      cells.append(0xffff)
+      continue
+    bits = bytearray((count + 7) // 8)
+    for i in visible: bits[i >> 3] |= 1 << (i & 7)
+    bits = bytes(bits)
+    if not bits in row_of:
+      row_of[bits] = len(rows)
+      rows.append(bits)
+    cells.append(row_of[bits])
+  out = [struct.pack('<4sII4f3H', b'YPV1', count, len(rows), *(list(origin) + [size] + list(dims)))]
+  out.append(b'\0\0')
+  out.append(_pack('H', cells))
+  out.append(b'\0' * (-len(cells) * 2 % 4))
+  out += rows
+  return b''.join(out)
+
 def _clean_name(name):
   name = name.replace('.', '_')
   name = name.replace('-', '_')
@@ -114,6 +1103,96 @@ class JSExporter(bpy.types.Operator):
   filepath = StringProperty()
   filename = StringProperty()
   directory = StringProperty()
+  use_instancing = BoolProperty(
+    name='Instancing',
+    description='Draw objects sharing a mesh with hardware instancing',
+    default=True
+  )
+  use_static_batching = BoolProperty(
+    name='Static batching',
+    description='Merge non-moving objects into world space batches per texture',
+    default=False
+  )
+  use_atlas = BoolProperty(
+    name='Texture atlases',
+    description='Pack small textures into atlases and remap UVs',
+    default=False
+  )
+  atlas_size = IntProperty(
+    name='Atlas size',
+    description='Maximum atlas width and height in pixels',
+    default=1024, min=64, max=8192
+  )
+  atlas_max_image = IntProperty(
+    name='Atlas image size',
+    description='Only images up to this width and height go into atlases',
+    default=256, min=1, max=4096
+  )
+  atlas_padding = IntProperty(
+    name='Atlas padding',
+    description='Pixels of repeated edge around each image in an atlas',
+    default=4, min=0, max=64
+  )
+  use_mipmaps = BoolProperty(
+    name='Mipmapped textures',
+    description='Resample textures to power of two sizes and write their mip chains',
+    default=False
+  )
+  texture_max_size = IntProperty(
+    name='Texture size',
+    description='Maximum texture width and height when mipmapping or compressing textures',
+    default=1024, min=1, max=8192
+  )
+  use_compressed_textures = BoolProperty(
+    name='Compressed textures',
+    description='Also write DXT and ETC1 compressed textures, resampled to power of two sizes, used where the browser supports them (slow)',
+    default=False
+  )
+  use_texture_placeholders = BoolProperty(
+    name='Texture placeholders',
+    description='Inline tiny thumbnails of textures in the scene, drawn until the textures load',
+    default=False
+  )
+  use_animation = BoolProperty(
+    name='Animation',
+    description='Bake object animation over the scene frame range',
+    default=False
+  )
+  use_skinning = BoolProperty(
+    name='Skinning',
+    description='Export armature deformed meshes in rest pose with bone weights, skinned by the renderer',
+    default=False
+  )
+  use_morph_targets = BoolProperty(
+    name='Shape keys',
+    description='Export shape keys as sparse morph targets blended by the renderer',
+    default=False
+  )
+  use_progressive = BoolProperty(
+    name='Progressive meshes',
+    description='Write meshes as binary streams that refine from a coarse approximation',
+    default=False
+  )
+  use_occlusion_culling = BoolProperty(
+    name='Occlusion culling',
+    description='Write bounding boxes, tested with occlusion queries by WebGL2 renderers to skip hidden objects',
+    default=False
+  )
+  use_visibility = BoolProperty(
+    name='Visibility sets',
+    description='Precompute which static objects are potentially visible from each cell of a grid over the scene, by ray sampling (slow)',
+    default=False
+  )
+  visibility_cells = IntProperty(
+    name='Visibility cells',
+    description='View cells along the longest side of the scene',
+    default=8, min=1, max=32
+  )
+  visibility_samples = IntProperty(
+    name='Visibility samples',
+    description='Rays cast from each view cell',
+    default=256, min=1, max=65536
+  )
 
   def execute(self, context):
 
@@ -135,91 +1214,464 @@ class JSExporter(bpy.types.Operator):
     jscode += '  this.rotate = params["rotate"];\n'
     jscode += '  this.scale = params["scale"];\n'
     jscode += '  this.textureID = params["texture image"];\n'
+    jscode += '  this.rangeTextureIDs = params["range textures"];\n'
+    jscode += '  this.instanceNames = params["instance names"];\n'
+    jscode += '  this.instances = params["instances"];\n'
+    jscode += '  this.skeleton = params["skeleton"];\n'
+    jscode += '  this.morphWeights = params["morph weights"];\n'
+    jscode += '  this.parent = params["parent"];\n'
+    jscode += '  this.parentInverse = params["parent inverse"];\n'
+    jscode += '  this.bounds = params["bounds"];\n'
     jscode += '}\n\n'
     jscode += 'function %s(params) {\n' % (classname)
     jscode += '  this.meshes = [];\n'
     jscode += '  this.textures = [];\n'
+    jscode += '  this.animation = null;\n'
+    jscode += '  this.visibility = null;\n'
     jscode += '  this.textureCallback = params["texture callback"];\n'
     jscode += '  this.textureArgs = params["texture arguments"];\n'
     jscode += '  this.vboCallback = params["vbo callback"];\n'
     jscode += '  this.vboArgs = params["vbo arguments"];\n'
+    jscode += '  this.streamCallback = params["stream callback"];\n'
+    jscode += '  this.loadCallback = params["load callback"];\n'
+    jscode += '  this.loadArgs = params["load arguments"];\n'
+    jscode += '}\n\n'
+    jscode += '%s.prototype.loaded = function(name) {\n' % (classname)
+    jscode += '  if (this.loadCallback) this.loadCallback(this, name, this.loadArgs);\n'
     jscode += '}\n\n'
     jscode += '%s.prototype.load = function(loader) {\n\n' % (classname)
     jscode += '  var parent = this;\n'
 
-    unique = []
+    # Download priorities, the estimated screen size of the largest object
+    # using a mesh or an image.
+    mesh_priority = {}
+    image_priority = {}
+    for obj in bpy.data.objects:
+      if obj.type != 'MESH': continue
+      if len(obj.data.faces) == 0: continue
+      size = _screen_size(*_object_bounds(obj))
+      mesh_priority[obj.data.name] = max(size, mesh_priority.get(obj.data.name, 0))
+      for image in set([_face_image(obj.data, face) for face in obj.data.faces]):
+        image_priority[image] = max(size, image_priority.get(image, 0))
+
+    # Image files are compared by content, image_alias maps the ids of
+    # duplicates to the id of the first file with the same content.
+    files = set()
+    digests = {}
+    image_alias = {}
+    images = []
     for img in bpy.data.images:
       if not img.filepath: continue
       file = os.path.basename(img.filepath)
-      if file in unique: continue
-      if not os.path.exists(os.path.join(self.directory, file)):
+      if file in files: continue
+      path = os.path.join(self.directory, file)
+      if not os.path.exists(path):
         # TODO: make image path configurable
         continue
-      unique.append(file)
+      files.add(file)
       imgid = _clean_name(file)
-      imgargs = (imgid, file, img.size[0], img.size[1])
-      jscode += '\n  // %s %dx%d\n' % (file, img.size[0], img.size[1])
+      digest = _file_digest(path)
+      if digest in digests:
+        image_alias[imgid] = digests[digest]
+        image_priority[digests[digest]] = max(
+          image_priority.get(imgid, 0), image_priority.get(digests[digest], 0)
+        )
+        continue
+      digests[digest] = imgid
+      images.append((imgid, file, img))
+
+    # Small textures are packed into atlases, atlas_of maps their ids to the
+    # atlas id and uvmap to the UV transform into atlas space.
+    atlases = []
+    atlas_of = {}
+    uvmap = {}
+    if self.use_atlas:
+      tiled = set([image_alias.get(i, i) for i in _tiled_IMAGES([
+        obj for obj in bpy.data.objects
+        if obj.type == 'MESH' and len(obj.data.faces)
+      ])])
+      atlases, uvmap = _build_ATLASES([
+        (imgid, img) for imgid, file, img in images
+        if not imgid in tiled and max(img.size[0], img.size[1]) <= self.atlas_max_image
+      ], self.atlas_size, self.atlas_padding)
+      for atlasid, file, w, h, members, pixels in atlases:
+        for imgid in members:
+          atlas_of[imgid] = atlasid
+        image_priority[atlasid] = max([image_priority.get(i, 0) for i in members])
+      for imgid, canonical in image_alias.items():
+        if canonical in uvmap: uvmap[imgid] = uvmap[canonical]
+
+    # Texture id a mesh's image id is drawn with.
+    texture_of = dict(atlas_of)
+    for imgid, canonical in image_alias.items():
+      texture_of[imgid] = atlas_of.get(canonical, canonical)
+
+    image_of = dict([(imgid, img) for imgid, file, img in images])
+    textures = [
+      (imgid, file, img.size[0], img.size[1], None, None) for imgid, file, img in images
+      if not imgid in atlas_of
+    ] + atlases
+    for imgid, file, w, h, members, pixels in textures:
+      info = ''
+      levels = None
+      placeholder = None
+      if self.use_mipmaps or self.use_compressed_textures or self.use_texture_placeholders:
+        if not pixels: w, h, pixels = _image_RGBA(image_of[imgid])
+      if self.use_mipmaps or self.use_compressed_textures:
+        levels = _mip_LEVELS(w, h, pixels, self.texture_max_size)
+        if not self.use_mipmaps: levels = levels[0:1]
+      if self.use_texture_placeholders:
+        placeholder = _json_PLACEHOLDER(w, h, pixels, self.use_mipmaps and levels)
+      compressed = []
+      if self.use_compressed_textures and min(levels[0][0], levels[0][1]) >= 4:
+        opaque = min(levels[0][2][3::4]) == 255
+        for name, opaqueformat, alphaformat in _TEXTURE_FORMATS:
+          format = opaqueformat if opaque else alphaformat
+          if not format: continue
+          suffix, glformat, encoder = format
+          cfile = '%s_%s.yct' % (os.path.splitext(file)[0], suffix)
+          print('output texture: %s' % (cfile))
+          f = open(os.path.join(self.directory, cfile), 'wb')
+          f.write(_binary_COMPRESSED(levels, glformat, encoder))
+          f.close()
+          compressed.append('"%s": "%s"' % (name, cfile))
+      if self.use_mipmaps:
+        # Power of two level 0 and its mip chain side by side in one file.
+        w, h = levels[0][0], levels[0][1]
+        sw, pixels = _mip_STRIP(levels)
+        file = os.path.splitext(file)[0] + '_mips.png'
+        print('output texture: %s %dx%d, %d levels' % (file, w, h, len(levels)))
+        _write_PNG(os.path.join(self.directory, file), sw, h, pixels)
+        info = ', { "width": %d, "height": %d, "levels": %d, "repeat": %s }' % (
+          w, h, len(levels), 'false' if members else 'true'
+        )
+        imgargs = (imgid, file, sw, h)
+      else:
+        if members:
+          print('output atlas: %s %dx%d' % (file, w, h))
+          _write_PNG(os.path.join(self.directory, file), w, h, pixels)
+        imgargs = (imgid, file, w, h)
+      jscode += '\n  // %s %dx%d\n' % (file, w, h)
+      if members:
+        jscode += '  // atlas of %s\n' % (', '.join(members))
+      if placeholder:
+        # Drawn until the texture loads, which then replaces it in place.
+        jscode += '  parent.textures["%s"] = parent.textureCallback(\n' % (imgid)
+        jscode += '    %s,\n' % (placeholder)
+        jscode += '    parent.textureArgs\n'
+        jscode += '  );\n'
+        info = '%s, parent.textures["%s"]' % (info or ', null', imgid)
       jscode += '  loader.loadTexture("%s", "%s", %d, %d, function(image) {\n' % imgargs
-      jscode += '    parent.textures["%s"] = parent.textureCallback(image, parent.textureArgs);\n' % (imgid)
-      jscode += '  });\n'
+      jscode += '    parent.textures["%s"] = parent.textureCallback(image, parent.textureArgs%s);\n' % (imgid, info)
+      jscode += '    parent.loaded(null);\n'
+      if compressed:
+        jscode += '  }, %s, { %s });\n' % (
+          _formatnum(image_priority.get(imgid, 0)), ', '.join(compressed)
+        )
+      else:
+        jscode += '  }, %s);\n' % _formatnum(image_priority.get(imgid, 0))
+
+    # Meshes deformed by an armature are exported in rest pose with bone
+    # weights, skins maps their object names to the armature and its bones.
+    skins = {}
+    if self.use_skinning:
+      for obj in bpy.data.objects:
+        if obj.type != 'MESH': continue
+        if len(obj.data.faces) == 0: continue
+        armature = _armature(obj)
+        if not armature: continue
+        bones = _bone_ORDER(armature)
+        if not bones: continue
+        if len(bones) > _MAX_BONES:
+          print('not skinned: %s, %d bones' % (obj.name, len(bones)))
+          continue
+        skins[obj.name] = (armature, bones)
+
+    # Evaluated meshes are compared by content and texture, mesh_of maps
+    # datablock names (see _data_KEY) to the name of the first datablock with
+    # the same content, whose data is kept in mesh_data. Meshes with shape keys are
+    # exported with all keys off and morphs holds their sparse targets.
+    mesh_of = {}
+    mesh_data = {}
+    morphs = {}
+    digests = {}
+    for obj in bpy.data.objects:
+      if obj.type != 'MESH': continue
+      if len(obj.data.faces) == 0: continue
+      key = _data_KEY(obj, skins)
+      if key in mesh_of: continue
+      mesh_priority[key] = mesh_priority[obj.data.name]
+      weights = None
+      if obj.name in skins: mesh, weights = _skin_MESH(obj, *skins[obj.name])
+      else: mesh = obj.create_mesh(bpy.context.scene, True, 'PREVIEW')
+      targets = None
+      if self.use_morph_targets and _shape_KEYS(obj):
+        bpy.data.meshes.remove(mesh)
+        if obj.name in skins:
+          evaluate = lambda: _skin_MESH(obj, *skins[obj.name])[0]
+        else:
+          evaluate = lambda: obj.create_mesh(bpy.context.scene, True, 'PREVIEW')
+        mesh, targets = _morph_TARGETS(evaluate, _shape_KEYS(obj))
+        if not targets: print('no morph targets: %s, modifiers change the vertices' % (obj.name))
+      vertex_of = []
+      data, indices, ranges = _mesh_DATA(
+        mesh, uvmap=uvmap, texture_of=texture_of, weights=weights, vertex_of=vertex_of
+      )
+      bpy.data.meshes.remove(mesh)
+      if targets:
+        morphs[key] = _binary_MORPHS(data, vertex_of, targets)
+        canonical = key
+      else:
+        digest = _mesh_digest(data, indices, ranges)
+        canonical = digests.setdefault(digest, key)
+      mesh_of[key] = canonical
+      if canonical == key:
+        mesh_data[canonical] = (data, indices, ranges)
+      else:
+        mesh_priority[canonical] = max(
+          mesh_priority[canonical], mesh_priority[key]
+        )
+
+    # Objects sharing a mesh are drawn as one instanced mesh.
+    instanced = {}
+    if self.use_instancing:
+      users = {}
+      for obj in bpy.data.objects:
+        if obj.type != 'MESH': continue
+        if len(obj.data.faces) == 0: continue
+        if self.use_animation and _is_animated(obj): continue
+        if obj.name in skins: continue
+        if self.use_animation and _data_KEY(obj, skins) in morphs and _keys_animated(obj): continue
+        if obj.parent: continue
+        users.setdefault(mesh_of[_data_KEY(obj, skins)], []).append(obj)
+      for dataname, objs in users.items():
+        if len(objs) > 1: instanced[dataname] = objs
+
+    # Non-moving objects are merged into world space batches per texture.
+    batches = {}
+    batch_members = {}
+    batched = set()
+    if self.use_static_batching:
+      for obj in bpy.data.objects:
+        if obj.type != 'MESH': continue
+        if len(obj.data.faces) == 0: continue
+        if mesh_of[_data_KEY(obj, skins)] in instanced: continue
+        if _is_animated(obj): continue
+        if obj.name in skins and _is_animated(skins[obj.name][0]): continue
+        if _data_KEY(obj, skins) in morphs and _keys_animated(obj): continue
+        image = _mesh_image(obj.data)
+        batches.setdefault(texture_of.get(image, image) or 'untextured', []).append(obj)
+      for image in batches:
+        batch_members[image] = []
+        batches[image] = _batch_MESHES(
+          batches[image], uvmap, texture_of, members=batch_members[image]
+        )
+        # Objects too big for a batch are drawn on their own.
+        for objs in batch_members[image]:
+          batched.update([obj.name for obj in objs])
 
     jscode += '\n  // Javascript objects\n'
+    for image in sorted(batches):
+      for n, (data, indices, ranges) in enumerate(batches[image]):
+        jscode += '  parent.meshes["batch_%s_%d"] = new Mesh({\n' % (image, n)
+        jscode += '    "translate": [0, 0, 0],\n'
+        jscode += '    "rotate": [0, 0, 0],\n'
+        jscode += '    "scale": [1, 1, 1],\n'
+        if self.use_occlusion_culling:
+          jscode += '    %s,\n' % _json_BOX(_data_BOX(data))
+        jscode += '    %s\n' % _json_TEXTURES(ranges)
+        jscode += '  });\n'
     for obj in bpy.data.objects:
       if obj.type != 'MESH': continue
       if len(obj.data.faces) == 0: continue
+      if obj.name in batched: continue
       objname = _clean_name(obj.name)
-      mesh = obj.data
-      image = 'null';
-      for t in mesh.uv_textures:
-        for d in t.data:
-          image = _clean_name(os.path.basename(
-            mesh.uv_textures[0].data[0].image.filepath
-          ))
-          break
+      dataname = mesh_of[_data_KEY(obj, skins)]
+      ranges = mesh_data[dataname][2]
+      if dataname in instanced and obj in instanced[dataname]:
+        objs = instanced[dataname]
+        if obj != objs[0]: continue
+        instname = _clean_name(dataname) + '_instances'
+        jscode += '  parent.meshes["%s"] = new Mesh({\n' % (instname)
+        jscode += '    "translate": [0, 0, 0],\n'
+        jscode += '    "rotate": [0, 0, 0],\n'
+        jscode += '    "scale": [1, 1, 1],\n'
+        jscode += '    %s,\n' % _json_TEXTURES(ranges)
+        if dataname in morphs:
+          jscode += '    "morph weights": [%s],\n' % _json_WEIGHTS(obj)
+        if self.use_occlusion_culling and not dataname in morphs:
+          jscode += '    %s,\n' % _json_BOX(
+            _instances_BOX(_data_BOX(mesh_data[dataname][0]), objs)
+          )
+        jscode += '    "instance names": [%s],\n' % (
+          ', '.join(['"%s"' % _clean_name(o.name) for o in objs])
+        )
+        jscode += '    "instances": [%s]\n' % _json_INSTANCES(objs)
+        jscode += '  });\n'
+        continue
       jscode += '  parent.meshes["%s"] = new Mesh({\n' % (objname)
-      jscode += '    "translate": [%f, %f, %f],\n' % (
-        obj.location[0],
-        obj.location[1],
-        obj.location[2]
-      )
-      jscode += '    "rotate": [%f, %f, %f],\n' % (
-        math.degrees(obj.rotation_euler[0]),
-        math.degrees(obj.rotation_euler[1]),
-        math.degrees(obj.rotation_euler[2])
-      )
-      jscode += '    "scale": [%f, %f, %f],\n' % (obj.scale[0], obj.scale[1], obj.scale[2])
-      jscode += '    "texture image": "%s"\n' % image
+      jscode += '    %s,\n' % _json_TRANSFORM(obj)
+      params = [_json_TEXTURES(ranges)]
+      if obj.name in skins:
+        params.append('"skeleton": %s' % _json_SKELETON(obj, *skins[obj.name]))
+      if dataname in morphs:
+        params.append('"morph weights": [%s]' % _json_WEIGHTS(obj))
+      # Skinned and morphed meshes leave their rest pose box, they are
+      # always drawn.
+      elif self.use_occlusion_culling and not obj.name in skins:
+        params.append(_json_BOX(_data_BOX(mesh_data[dataname][0])))
+      jscode += '    %s\n' % (',\n    '.join(params))
+      jscode += '  });\n'
+
+    # Parents that aren't drawn as meshes of their own are transform only
+    # nodes, so their children can follow them.
+    drawn = set([
+      obj.name for obj in bpy.data.objects
+      if obj.type == 'MESH' and len(obj.data.faces) and not obj.name in batched and
+      not (mesh_of[_data_KEY(obj, skins)] in instanced and obj in instanced[mesh_of[_data_KEY(obj, skins)]])
+    ])
+    ancestors = set()
+    for obj in bpy.data.objects:
+      if not obj.name in drawn: continue
+      while obj.parent:
+        obj = obj.parent
+        ancestors.add(obj.name)
+    nodes = [
+      obj for obj in bpy.data.objects if obj.name in ancestors and not obj.name in drawn
+    ]
+    for obj in nodes:
+      jscode += '  parent.meshes["%s"] = new Mesh({\n' % (_clean_name(obj.name))
+      jscode += '    %s\n' % _json_TRANSFORM(obj)
       jscode += '  });\n'
 
-    loaded = []
-    jscode += '\n  // JSON\n'
+    loaded = set()
+    jscode += '\n  // Meshes\n'
+    for image in sorted(batches):
+      for n, (data, indices, ranges) in enumerate(batches[image]):
+        batchname = 'batch_%s_%d' % (image, n)
+        print("output batch: %s " % (batchname))
+        load, path, callback = _write_MESH(
+          jsdir, batchname, data, indices, ranges, self.use_progressive
+        )
+        jscode += '  loader.%s("%s", function(data) {\n' % (load, path)
+        jscode += '    parent.meshes["%s"].vbo = parent.%s(data, parent.vboArgs);\n' % (batchname, callback)
+        jscode += '    parent.loaded("%s");\n' % (batchname)
+        jscode += '  }, %s);\n' % _formatnum(_screen_size(*_data_bounds(data)))
     for obj in bpy.data.objects:
       if obj.type != 'MESH': continue
       if len(obj.data.faces) == 0: continue
-      mesh = obj.create_mesh(bpy.context.scene, True, 'PREVIEW')
-      dataname = _clean_name(obj.data.name)
-      jsonfile = os.path.join(jsdir, "%s.json" % (dataname))
-      jsonpath = "js/%s.json" % (dataname)
-      if not jsonpath in loaded:
-        print("output mesh: %s " % (dataname))
-        loaded.append(jsonpath)
-        json = '{'
-        json += '"name": "%s"' % (dataname)
-        json += _json_MESH(mesh)
-        json += '}\n'
-        jscode += '  loader.loadJSONData("%s", function(data) {\n' % (jsonpath)
-        jscode += '    var vbo = parent.vboCallback(data, parent.vboArgs);\n'
+      if obj.name in batched: continue
+      dataname = mesh_of[_data_KEY(obj, skins)]
+      if not dataname in loaded:
+        print("output mesh: %s " % (_clean_name(dataname)))
+        loaded.add(dataname)
+        data, indices, ranges = mesh_data[dataname]
+        # Progressive streams don't carry bone weights, and morph targets
+        # need the whole mesh.
+        load, path, callback = _write_MESH(
+          jsdir, _clean_name(dataname), data, indices, ranges,
+          self.use_progressive and len(data[0]) == 8 and not dataname in morphs
+        )
+        users = []
+        if dataname in instanced:
+          users.append(_clean_name(dataname) + '_instances')
         for obj2 in bpy.data.objects:
           if obj2.type != 'MESH': continue
-          if obj2.data and obj2.data.name == obj.data.name:
-            data2name = _clean_name(obj2.name)
-            jscode += '    parent.meshes["%s"].vbo = vbo;\n' % data2name
-        jscode += '  });\n'
-
-        f = open(os.path.join(self.directory, jsonfile), 'w')
-        if not f: raise ('Could not open file for writing.')
-        f.write(json)
+          if obj2.name in batched: continue
+          if dataname in instanced and obj2 in instanced[dataname]: continue
+          if obj2.data and mesh_of.get(_data_KEY(obj2, skins)) == dataname:
+            users.append(_clean_name(obj2.name))
+        jscode += '  loader.%s("%s", function(data) {\n' % (load, path)
+        jscode += '    var vbo = parent.%s(data, parent.vboArgs);\n' % (callback)
+        for name in users:
+          jscode += '    parent.meshes["%s"].vbo = vbo;\n' % name
+          jscode += '    parent.loaded("%s");\n' % name
+        jscode += '  }, %s);\n' % _formatnum(mesh_priority[dataname])
+        if dataname in morphs:
+          path = 'js/%s_morphs.bin' % (_clean_name(dataname))
+          print("output morph targets: %s" % (path))
+          f = open(os.path.join(self.directory, path), 'wb')
+          f.write(morphs[dataname])
+          f.close()
+          jscode += '  // shape keys %s\n' % (
+            ', '.join([key.name for key in _shape_KEYS(obj)])
+          )
+          jscode += '  loader.loadArrayBuffer("%s", function(buffer) {\n' % (path)
+          jscode += '    var morphs = new MorphTargets(buffer);\n'
+          for name in users:
+            jscode += '    parent.meshes["%s"].morphs = morphs;\n' % name
+            jscode += '    parent.loaded("%s");\n' % name
+          jscode += '  }, %s);\n' % _formatnum(mesh_priority[dataname])
+
+    if self.use_animation:
+      # Objects follow their parents, only their own actions are sampled.
+      animated = [
+        obj for obj in bpy.data.objects
+        if obj.name in drawn and (
+          _has_action(obj) or
+          obj.name in skins and _is_animated(skins[obj.name][0]) or
+          _data_KEY(obj, skins) in morphs and _keys_animated(obj)
+        ) or obj.name in ancestors and _has_action(obj)
+      ]
+      scene = bpy.context.scene
+      animation = _binary_ANIMATION(
+        _sample_TRACKS(animated, scene, skins, morphs),
+        float(scene.render.fps) / scene.render.fps_base
+      )
+      if animation:
+        print("output animation: %d objects" % (len(animated)))
+        f = open(os.path.join(jsdir, 'animation.bin'), 'wb')
+        f.write(animation)
+        f.close()
+        jscode += '\n  // Animation\n'
+        jscode += '  loader.loadArrayBuffer("js/animation.bin", function(buffer) {\n'
+        jscode += '    parent.animation = new Animation(buffer, parent.meshes, [%s]);\n' % (
+          ', '.join(['"%s"' % _clean_name(obj.name) for obj in animated])
+        )
+        jscode += '    parent.loaded(null);\n'
+        jscode += '  }, 1);\n'
+
+    if self.use_visibility:
+      # Sets index the meshes drawing static objects: their own, their batch
+      # or their instanced mesh. Meshes of moving objects are always drawn.
+      groups = []
+      for image in sorted(batches):
+        for n, objs in enumerate(batch_members[image]):
+          groups.append(('batch_%s_%d' % (image, n), objs))
+      for dataname in sorted(instanced):
+        groups.append((_clean_name(dataname) + '_instances', instanced[dataname]))
+      for obj in bpy.data.objects:
+        if obj.name in drawn: groups.append((_clean_name(obj.name), [obj]))
+      groups = [
+        (name, objs) for name, objs in groups if not [
+          obj for obj in objs if _is_animated(obj) or
+          obj.name in skins and _is_animated(skins[obj.name][0]) or
+          _data_KEY(obj, skins) in morphs and _keys_animated(obj)
+        ]
+      ]
+      if groups:
+        index_of = {}
+        for i, (name, objs) in enumerate(groups):
+          for obj in objs: index_of[obj.name] = i
+        boxes = [_world_BOX(objs) for name, objs in groups]
+        lo = [min([b[i] for b in boxes]) for i in range(3)]
+        hi = [max([b[i + 3] for b in boxes]) for i in range(3)]
+        size = max([hi[i] - lo[i] for i in range(3)]) / self.visibility_cells or 1.0
+        dims = [max(1, int(math.ceil((hi[i] - lo[i]) / size))) for i in range(3)]
+        sets = _visibility_SETS(
+          bpy.context.scene, boxes, index_of, lo, size, dims, self.visibility_samples
+        )
+        print("output visibility: %d cells, %d objects" % (len(sets), len(groups)))
+        f = open(os.path.join(jsdir, 'visibility.bin'), 'wb')
+        f.write(_binary_VISIBILITY(len(groups), lo, size, dims, sets))
         f.close()
+        jscode += '\n  // Visibility\n'
+        jscode += '  loader.loadArrayBuffer("js/visibility.bin", function(buffer) {\n'
+        jscode += '    parent.visibility = new VisibilitySets(buffer, parent.meshes, [%s]);\n' % (
+          ', '.join(['"%s"' % name for name, objs in groups])
+        )
+        jscode += '    parent.loaded(null);\n'
+        jscode += '  }, 1);\n'
 
     jscode += '}\n'
 
@@ -240,6 +1692,12 @@ class JSExporter(bpy.types.Operator):
       f.write(LOADER)
       f.close()
 
+    worker = os.path.join(jsdir, 'webgl-jso-meshworker.js')
+    if not os.path.isfile(worker):
+      f = open(worker, 'w')
+      f.write(WORKER)
+      f.close()
+
     renderer = os.path.join(jsdir, 'webgl-jso-basicrenderer.js')
     if not os.path.isfile(renderer):
       f = open(renderer, 'w')
@@ -2011,11 +3469,286 @@ quat4.str = function(quat) {
 
 LOADER = """// TODO: header
 
+// ----------------------------
+// PriorityQueue
+// ----------------------------
+
+// Binary max-heap, items of equal priority come out in insertion order.
+function PriorityQueue() {
+  this.heap = [];
+  this.sequence = 0;
+}
+
+PriorityQueue.prototype.length = function() {
+  return this.heap.length;
+}
+
+PriorityQueue.prototype.before = function(a, b) {
+  if (a.priority != b.priority) return a.priority > b.priority;
+  return a.sequence < b.sequence;
+}
+
+PriorityQueue.prototype.push = function(item, priority) {
+  var heap = this.heap;
+  var node = { item: item, priority: priority, sequence: this.sequence++ };
+  var i = heap.length;
+  heap[i] = node;
+  while (i > 0) {
+    var parent = (i - 1) >> 1;
+    if (!this.before(node, heap[parent])) break;
+    heap[i] = heap[parent];
+    i = parent;
+  }
+  heap[i] = node;
+}
+
+PriorityQueue.prototype.pop = function() {
+  var heap = this.heap;
+  var top = heap[0];
+  var last = heap.pop();
+  if (heap.length) {
+    var i = 0;
+    while (true) {
+      var child = i * 2 + 1;
+      if (child >= heap.length) break;
+      if (child + 1 < heap.length && this.before(heap[child + 1], heap[child])) {
+        child++;
+      }
+      if (!this.before(heap[child], last)) break;
+      heap[i] = heap[child];
+      i = child;
+    }
+    heap[i] = last;
+  }
+  return top.item;
+}
+
+// ----------------------------
+// WorkerPool
+// ----------------------------
+
+// Fetches and decodes mesh payloads in Web Workers (see
+// webgl-jso-meshworker.js). Decoded typed arrays are transferred back
+// without copying. The worker script reports decoding errors itself, a
+// worker raising an error event (the script didn't load, say) is dropped
+// from the pool.
+function WorkerPool(src, count) {
+  var pool = this;
+  this.workers = [];
+  this.callbacks = {};
+  this.lastid = 0;
+  for (var i = 0; i < count; i++) {
+    var worker = new Worker(src);
+    worker.pending = 0;
+    worker.ids = {};
+    worker.onmessage = function(event) {
+      this.pending--;
+      delete this.ids[event.data.id];
+      pool.receive(event.data);
+    };
+    worker.onerror = function(event) {
+      event.preventDefault();
+      pool.drop(this);
+    };
+    this.workers[i] = worker;
+  }
+}
+
+// Calls callback with the decoded data, or null on failure. The second
+// argument is true when no worker could handle the request, the caller
+// should then load it some other way.
+WorkerPool.prototype.decode = function(src, format, callback) {
+  if (!this.workers.length) {
+    callback(null, true);
+    return;
+  }
+  var worker = this.workers[0];
+  for (var i = 1; i < this.workers.length; i++) {
+    if (this.workers[i].pending < worker.pending) worker = this.workers[i];
+  }
+  var id = ++this.lastid;
+  this.callbacks[id] = callback;
+  worker.ids[id] = true;
+  worker.pending++;
+  worker.postMessage({ id: id, src: absoluteURL(src), format: format });
+}
+
+WorkerPool.prototype.receive = function(message) {
+  var callback = this.callbacks[message.id];
+  if (!callback) return;
+  delete this.callbacks[message.id];
+  callback(message.error ? null : message.data, false);
+}
+
+// Terminates a failed worker and hands its requests back.
+WorkerPool.prototype.drop = function(worker) {
+  var i = this.workers.indexOf(worker);
+  if (i < 0) return;
+  this.workers.splice(i, 1);
+  worker.terminate();
+  var ids = worker.ids;
+  worker.ids = {};
+  for (var id in ids) {
+    var callback = this.callbacks[id];
+    delete this.callbacks[id];
+    callback(null, true);
+  }
+}
+
+// Workers resolve URLs against the worker script, not the page.
+function absoluteURL(src) {
+  var a = document.createElement('a');
+  a.href = src;
+  return a.href;
+}
+
+// ----------------------------
+// MeshStreamParser
+// ----------------------------
+
+// Incremental parser for the exporter's progressive mesh streams. Calls
+// callback with the stream header { vertexCount, indexCount, levelCount,
+// uint32Indices, rangeCount, onlevel } as soon as it arrives, then
+// stream.onlevel with every complete level { index, firstVertex,
+// vertexCount, vertices, normals, texcoords, indices, ranges, last }. A
+// level carries the vertices it introduces, its complete index list and,
+// for meshes with draw ranges, the index count of each.
+function MeshStreamParser(callback) {
+  this.callback = callback;
+  this.bytes = new Uint8Array(65536);
+  this.length = 0;
+  this.offset = 0;
+  this.stream = null;
+  this.level = 0;
+  this.firstVertex = 0;
+}
+
+MeshStreamParser.prototype.complete = function() {
+  return this.stream && this.level == this.stream.levelCount;
+}
+
+MeshStreamParser.prototype.push = function(chunk) {
+  if (this.length + chunk.length > this.bytes.length) {
+    var size = this.bytes.length;
+    while (size < this.length - this.offset + chunk.length) size *= 2;
+    var bytes = new Uint8Array(size);
+    bytes.set(this.bytes.subarray(this.offset, this.length));
+    this.length -= this.offset;
+    this.offset = 0;
+    this.bytes = bytes;
+  }
+  this.bytes.set(chunk, this.length);
+  this.length += chunk.length;
+  this.parse();
+}
+
+MeshStreamParser.prototype.uint32 = function(at) {
+  var b = this.bytes;
+  return (b[at] | (b[at+1] << 8) | (b[at+2] << 16)) + b[at+3] * 16777216;
+}
+
+MeshStreamParser.prototype.array = function(type, at, count) {
+  return new type(this.bytes.buffer.slice(at, at + count * type.BYTES_PER_ELEMENT));
+}
+
+MeshStreamParser.prototype.parse = function() {
+  while (true) {
+    var at = this.offset;
+    var available = this.length - at;
+    if (!this.stream) {
+      if (available < 20) return;
+      var b = this.bytes;
+      if (b[at] != 89 || b[at+1] != 80 || b[at+2] != 77 || b[at+3] != 49) {
+        throw 'Not a progressive mesh stream';
+      }
+      var flags = this.uint32(at + 16);
+      if ((flags & 2) && available < 24) return;
+      this.stream = {
+        vertexCount: this.uint32(at + 4),
+        indexCount: this.uint32(at + 8),
+        levelCount: this.uint32(at + 12),
+        uint32Indices: (flags & 1) ? true : false,
+        rangeCount: (flags & 2) ? this.uint32(at + 20) : 0,
+        onlevel: null
+      };
+      this.offset += (flags & 2) ? 24 : 20;
+      this.callback(this.stream);
+      continue;
+    }
+    if (this.complete() || available < 8) return;
+    var vertexCount = this.uint32(at);
+    var indexCount = this.uint32(at + 4);
+    var indexType = this.stream.uint32Indices ? Uint32Array : Uint16Array;
+    var indexBytes = (indexCount * indexType.BYTES_PER_ELEMENT + 3) & ~3;
+    var rangeBytes = this.stream.rangeCount * 4;
+    var size = 8 + rangeBytes + vertexCount * 32 + indexBytes;
+    if (available < size) return;
+    var ranges = null;
+    if (rangeBytes) ranges = this.array(Uint32Array, at + 8, this.stream.rangeCount);
+    at += 8 + rangeBytes;
+    var level = {
+      index: this.level,
+      firstVertex: this.firstVertex,
+      vertexCount: vertexCount,
+      vertices: this.array(Float32Array, at, vertexCount * 3),
+      normals: this.array(Float32Array, at + vertexCount * 12, vertexCount * 3),
+      texcoords: this.array(Float32Array, at + vertexCount * 24, vertexCount * 2),
+      indices: this.array(indexType, at + vertexCount * 32, indexCount),
+      ranges: ranges,
+      last: this.level == this.stream.levelCount - 1
+    };
+    this.offset += size;
+    this.level++;
+    this.firstVertex += vertexCount;
+    if (this.stream.onlevel) this.stream.onlevel(level);
+  }
+}
+
+// Parses the exporter's compressed texture files into { compressed, format,
+// width, height, levels } with the blocks of each mip level in a Uint8Array,
+// returns null if buffer is not one.
+function parseCompressedTexture(buffer) {
+  if (buffer.byteLength < 20) return null;
+  var view = new DataView(buffer);
+  if (view.getUint32(0, true) != 0x31544359) return null;
+  var texture = {
+    compressed: true,
+    format: view.getUint32(4, true),
+    width: view.getUint32(8, true),
+    height: view.getUint32(12, true),
+    levels: []
+  };
+  var count = view.getUint32(16, true);
+  var at = 20;
+  for (var i = 0; i < count; i++) {
+    var length = view.getUint32(at, true);
+    if (at + 4 + length > buffer.byteLength) return null;
+    texture.levels[i] = new Uint8Array(buffer, at + 4, length);
+    at += 4 + length;
+  }
+  return texture;
+}
+
 // ----------------------------
 // JQueryLoader
 // ----------------------------
 
+// Requests are queued by priority (higher first, the exporter uses the
+// estimated screen size of the objects using a resource) and at most
+// 'max requests' run at once. With a 'worker script' and browser support,
+// meshes are fetched and decoded in a pool of 'worker count' Web Workers.
+// Textures exported in compressed formats are loaded in the first of
+// 'texture formats' (see BasicRenderer.textureFormats) available.
 function JQueryLoader(params) {
+  this.maxRequests = params['max requests'] || 6;
+  this.active = 0;
+  this.queue = new PriorityQueue();
+  this.workers = null;
+  if (params['worker script'] && window.Worker) {
+    var count = params['worker count'] ||
+      Math.min(Math.max((navigator.hardwareConcurrency || 2) - 1, 1), 4);
+    this.workers = new WorkerPool(params['worker script'], count);
+  }
   this.requestsout = 0;
   this.requestsin = 0;
   this.expander = params['expander'];
@@ -2025,6 +3758,10 @@ function JQueryLoader(params) {
   this.percent_display = params['percent label'];
   this.itemcount_display = params['itemcount label'];
   this.resources = [];
+  this.imageBitmaps = window.createImageBitmap && window.Blob ? true : false;
+  this.textureFormats = params['texture formats'] || [];
+  this.logTimings = params['log timings'];
+  this.textureTimings = [];
   this.update();
 }
 
@@ -2048,12 +3785,41 @@ JQueryLoader.prototype.response = function() {
   this.update();
 }
 
+// Queues start, a function taking a done callback it must call once the
+// request has finished.
+JQueryLoader.prototype.enqueue = function(start, priority) {
+  this.queue.push(start, priority || 0);
+  this.pump();
+}
+
+JQueryLoader.prototype.pump = function() {
+  var loader = this;
+  var done = function() {
+    loader.active--;
+    loader.pump();
+  };
+  while (this.active < this.maxRequests && this.queue.length()) {
+    this.active++;
+    this.queue.pop()(done);
+  }
+}
+
+JQueryLoader.prototype.error = function(src) {
+  this.log('Could not load ' + src);
+}
+
+JQueryLoader.prototype.log = function(msg) {
+  if (window.console && window.console.log) {
+    window.console.log(msg);
+  }
+}
+
 JQueryLoader.prototype.percent = function() {
   if (this.requestsout == 0) return 0;
   return (this.requestsin / this.requestsout) * 100.0;
 }
 
-JQueryLoader.prototype.loadJSONData = function(src, callback) {
+JQueryLoader.prototype.loadJSONData = function(src, callback, priority) {
   var loader = this;
   if (loader.resources[src]) {
     // Don't load JSON more than once.
@@ -2061,14 +3827,151 @@ JQueryLoader.prototype.loadJSONData = function(src, callback) {
   }
   loader.resources[src] = true;
   loader.request();
-  $.getJSON(src, function(data) {
-    callback(data);
-    loader.response();
-  });
+  var ajax = function(done) {
+    $.ajax({
+      url: src,
+      dataType: 'json',
+      success: function(data) {
+        callback(data);
+        loader.response();
+        done();
+      },
+      error: function() {
+        loader.error(src);
+        loader.response();
+        done();
+      }
+    });
+  };
+  if (loader.workers) {
+    loader.enqueue(function(done) {
+      loader.workers.decode(src, 'json', function(data, failed) {
+        // Requests of a failed worker are loaded on the main thread.
+        if (failed) return ajax(done);
+        if (data) callback(data);
+        else loader.error(src);
+        loader.response();
+        done();
+      });
+    }, priority);
+    return;
+  }
+  loader.enqueue(ajax, priority);
+}
+
+// Loads a progressive mesh stream. callback gets the stream header as soon as
+// it arrives (see MeshStreamParser) and should set stream.onlevel to receive
+// the levels. With fetch streaming support levels are handed over while the
+// rest of the file is still downloading.
+JQueryLoader.prototype.loadMeshStream = function(src, callback, priority) {
+  var loader = this;
+  if (loader.resources[src]) {
+    // Don't load streams more than once.
+    return;
+  }
+  loader.resources[src] = true;
+  loader.request();
+  loader.enqueue(function(done) {
+    var parser = new MeshStreamParser(callback);
+    var finished = false;
+    var finish = function(ok) {
+      if (finished) return;
+      finished = true;
+      if (!ok || !parser.complete()) loader.error(src);
+      loader.response();
+      done();
+    };
+    var push = function(chunk) {
+      try {
+        parser.push(chunk);
+        return true;
+      }
+      catch (e) {
+        finish(false);
+        return false;
+      }
+    };
+    if (window.fetch && window.ReadableStream) {
+      fetch(src).then(function(response) {
+        if (!response.ok) {
+          finish(false);
+          return;
+        }
+        var reader = response.body.getReader();
+        var read = function() {
+          reader.read().then(function(result) {
+            if (result.done) finish(true);
+            else if (push(result.value)) read();
+          }, function() { finish(false); });
+        };
+        read();
+      }, function() { finish(false); });
+      return;
+    }
+    var request = new XMLHttpRequest();
+    request.open('GET', src, true);
+    request.responseType = 'arraybuffer';
+    request.onload = function() {
+      if (request.status != 200 && request.status != 0) {
+        finish(false);
+        return;
+      }
+      if (push(new Uint8Array(request.response))) finish(true);
+    };
+    request.onerror = function() { finish(false); };
+    request.send();
+  }, priority);
+}
+
+// Loads src and calls callback with it as an ArrayBuffer.
+JQueryLoader.prototype.loadArrayBuffer = function(src, callback, priority) {
+  var loader = this;
+  if (loader.resources[src]) {
+    return;
+  }
+  loader.resources[src] = true;
+  loader.request();
+  loader.enqueue(function(done) {
+    var finish = function() {
+      loader.response();
+      done();
+    };
+    var request = new XMLHttpRequest();
+    request.open('GET', src, true);
+    request.responseType = 'arraybuffer';
+    request.onload = function() {
+      if (request.status != 200 && request.status != 0) loader.error(src);
+      else callback(request.response);
+      finish();
+    };
+    request.onerror = function() {
+      loader.error(src);
+      finish();
+    };
+    request.send();
+  }, priority);
+}
+
+// First of the loader's texture formats compressed has a file for.
+JQueryLoader.prototype.textureFormat = function(compressed) {
+  if (!compressed) return null;
+  for (var i = 0; i < this.textureFormats.length; i++) {
+    if (compressed[this.textureFormats[i]]) return this.textureFormats[i];
+  }
+  return null;
 }
 
+// compressed optionally maps texture format names to compressed versions of
+// src, the callback then gets a parsed compressed texture instead of an
+// image if one of them is usable. Images are fetched as blobs and decoded
+// off the main thread with createImageBitmap where supported, otherwise
+// loaded through hidden <img> elements. Per texture timings in milliseconds
+// are kept in textureTimings: fetch, decode (null when the browser decodes
+// during upload) and upload, which covers the callback. The timing is passed
+// along as image.timing, a callback that defers the upload sets its
+// deferred flag, measures upload itself and calls its uploaded() when done.
 JQueryLoader.prototype.loadTexture = function(
-  id, src, width, height, callback
+  id, src, width, height, callback, priority, compressed
 ) {
   var loader = this;
   if (loader.resources[src]) {
@@ -2077,8 +3980,99 @@ JQueryLoader.prototype.loadTexture = function(
   }
   loader.resources[src] = true;
   loader.request();
-  var img = $("<img/>")
-    .attr("src", src)
+  loader.enqueue(function(done) {
+    var timing = {
+      src: src, path: 'img', fetch: 0, decode: null, upload: 0, deferred: false
+    };
+    timing.uploaded = function() {
+      loader.textureTimings[loader.textureTimings.length] = timing;
+      if (loader.logTimings) {
+        loader.log(src + ' (' + timing.path + ') fetch ' + timing.fetch.toFixed(1) +
+          'ms, decode ' + (timing.decode === null ? '-' : timing.decode.toFixed(1) + 'ms') +
+          ', upload ' + timing.upload.toFixed(1) + 'ms');
+      }
+    };
+    var start = loader.now();
+    var loaded = function(image) {
+      image.timing = timing;
+      var uploadstart = loader.now();
+      callback(image);
+      if (!timing.deferred) {
+        timing.upload = loader.now() - uploadstart;
+        timing.uploaded();
+      }
+      loader.response();
+      done();
+    };
+    var fallback = function() {
+      start = loader.now();
+      timing.path = 'img';
+      loader.loadImage(id, src, width, height, function(img) {
+        timing.fetch = loader.now() - start;
+        if (img) loaded(img);
+        else {
+          loader.error(src);
+          loader.response();
+          done();
+        }
+      });
+    };
+    var image = function() {
+      if (!loader.imageBitmaps) {
+        fallback();
+        return;
+      }
+      start = loader.now();
+      timing.path = 'imagebitmap';
+      var request = new XMLHttpRequest();
+      request.open('GET', src, true);
+      request.responseType = 'blob';
+      request.onload = function() {
+        if (request.status != 200 && request.status != 0) {
+          fallback();
+          return;
+        }
+        timing.fetch = loader.now() - start;
+        var decodestart = loader.now();
+        createImageBitmap(request.response, {
+          premultiplyAlpha: 'none', colorSpaceConversion: 'none'
+        }).then(function(bitmap) {
+          timing.decode = loader.now() - decodestart;
+          loaded(bitmap);
+        }, fallback);
+      };
+      request.onerror = fallback;
+      request.send();
+    };
+    var format = loader.textureFormat(compressed);
+    if (!format) {
+      image();
+      return;
+    }
+    timing.path = format;
+    var request = new XMLHttpRequest();
+    request.open('GET', compressed[format], true);
+    request.responseType = 'arraybuffer';
+    request.onload = function() {
+      if (request.status != 200 && request.status != 0) {
+        image();
+        return;
+      }
+      timing.fetch = loader.now() - start;
+      var decodestart = loader.now();
+      var texture = parseCompressedTexture(request.response);
+      timing.decode = loader.now() - decodestart;
+      if (texture) loaded(texture);
+      else image();
+    };
+    request.onerror = image;
+    request.send();
+  }, priority);
+}
+
+// Loads src into a hidden <img>, calls callback with it or null on failure.
+JQueryLoader.prototype.loadImage = function(id, src, width, height, callback) {
+  $("<img/>")
     .attr("id", id)
     .attr("width", width + "px")
     .attr("height", height + "px")
@@ -2086,11 +4080,94 @@ JQueryLoader.prototype.loadTexture = function(
     .appendTo("BODY")
     .load(function() {
       callback(this);
-      loader.response();
-    });
+    })
+    .error(function() {
+      callback(null);
+    })
+    .attr("src", src);
+}
+
+JQueryLoader.prototype.now = function() {
+  if (window.performance && window.performance.now) {
+    return window.performance.now();
+  }
+  return new Date().getTime();
 }
 """
 
+WORKER = """// TODO: header
+
+// ----------------------------
+// Mesh decoding worker
+// ----------------------------
+
+// Receives { id, src, format } messages, fetches src and replies with
+// { id, data } where every vertex attribute and the indices are typed
+// arrays. Their buffers are transferred, not copied.
+
+var ARRAY_TYPES = {
+  'vertices': Float32Array,
+  'normals': Float32Array,
+  'texcoords': Float32Array,
+  'bones': Uint8Array,
+  'weights': Uint8Array
+};
+
+var decoders = {
+  'json': {
+    responseType: 'text',
+    decode: function(response, transfer) {
+      var data = JSON.parse(response);
+      for (var key in data) {
+        var value = data[key];
+        var type = ARRAY_TYPES[key];
+        if (key == 'indices') {
+          type = Uint16Array;
+          for (var i = 0; i < value.length; i++) {
+            if (value[i] > 65535) {
+              type = Uint32Array;
+              break;
+            }
+          }
+        }
+        if (!type) continue;
+        data[key] = new type(value);
+        transfer[transfer.length] = data[key].buffer;
+      }
+      return data;
+    }
+  }
+};
+
+self.onmessage = function(event) {
+  var message = event.data;
+  var decoder = decoders[message.format];
+  var request = new XMLHttpRequest();
+  request.open('GET', message.src, true);
+  request.responseType = decoder.responseType;
+  request.onload = function() {
+    if (request.status != 200 && request.status != 0) {
+      self.postMessage({ id: message.id, error: request.status });
+      return;
+    }
+    var transfer = [];
+    var data = null;
+    try {
+      data = decoder.decode(request.response, transfer);
+    }
+    catch (e) {
+      self.postMessage({ id: message.id, error: e.message });
+      return;
+    }
+    self.postMessage({ id: message.id, data: data }, transfer);
+  };
+  request.onerror = function() {
+    self.postMessage({ id: message.id, error: 'network' });
+  };
+  request.send();
+};
+"""
+
 RENDERER = """// TODO: header
 
 var lastboundtexture = false;
@@ -2100,12 +4177,70 @@ var last_program_id = 0;
 var last_vbo_id = 0;
 var WebGLDebugUtils;
 
+var nativeRequestFrame = window.requestAnimationFrame ||
+  window.webkitRequestAnimationFrame ||
+  window.mozRequestAnimationFrame ||
+  window.oRequestAnimationFrame ||
+  window.msRequestAnimationFrame;
+
 function log(msg) {
   if (window.console && window.console.log) {
     window.console.log(msg);
   }
 }
 
+// Names of the counters kept in BasicRenderer.stats (totals) and
+// BasicRenderer.frameStats (last rendered frame).
+var RENDERER_STATS = [
+  'frames',
+  'draw calls',
+  'uniform uploads',
+  'uniform uploads saved',
+  'buffer bytes uploaded',
+  'allocating frames',
+  'occlusion tests',
+  'occlusion culled',
+  'occlusion queries',
+  'visibility culled'
+];
+
+function resetStats(stats) {
+  for (var i = 0; i < RENDERER_STATS.length; i++) {
+    stats[RENDERER_STATS[i]] = 0;
+  }
+  return stats;
+}
+
+function matrixEquals(a, b) {
+  for (var i = 0; i < 16; i++) {
+    if (a[i] != b[i]) return false;
+  }
+  return true;
+}
+
+// Used JS heap size where the browser reports it (Chrome, exact with
+// --enable-precise-memory-info), otherwise 0.
+function usedHeap() {
+  if (window.performance && window.performance.memory) {
+    return window.performance.memory.usedJSHeapSize;
+  }
+  return 0;
+}
+
+function now() {
+  if (window.performance && window.performance.now) {
+    return window.performance.now();
+  }
+  return new Date().getTime();
+}
+
+function requestFrame(callback) {
+  if (nativeRequestFrame) {
+    return nativeRequestFrame.call(window, callback);
+  }
+  return window.setTimeout(callback, 1000 / 60);
+}
+
 function hashcounter(hash) {
   var size = 0, key;
   for (key in hash) {
@@ -2116,15 +4251,124 @@ function hashcounter(hash) {
   return size;
 };
 
+// Vertex array objects, native in WebGL2 or through OES_vertex_array_object.
+function VertexArrays(gl) {
+  this.gl = gl;
+  this.ext = null;
+  if (gl.createVertexArray) {
+    this.supported = true;
+  }
+  else {
+    this.ext = gl.getExtension('OES_vertex_array_object') ||
+      gl.getExtension('MOZ_OES_vertex_array_object') ||
+      gl.getExtension('WEBKIT_OES_vertex_array_object');
+    this.supported = this.ext ? true : false;
+  }
+}
+
+VertexArrays.prototype.create = function() {
+  if (this.ext) return this.ext.createVertexArrayOES();
+  return this.gl.createVertexArray();
+}
+
+VertexArrays.prototype.bind = function(vao) {
+  if (this.ext) this.ext.bindVertexArrayOES(vao);
+  else this.gl.bindVertexArray(vao);
+}
+
+// Instanced drawing, native in WebGL2 or through ANGLE_instanced_arrays.
+function Instancing(gl) {
+  this.gl = gl;
+  this.ext = null;
+  if (gl.drawElementsInstanced) {
+    this.supported = true;
+  }
+  else {
+    this.ext = gl.getExtension('ANGLE_instanced_arrays');
+    this.supported = this.ext ? true : false;
+  }
+}
+
+Instancing.prototype.divisor = function(index, divisor) {
+  if (this.ext) this.ext.vertexAttribDivisorANGLE(index, divisor);
+  else this.gl.vertexAttribDivisor(index, divisor);
+}
+
+Instancing.prototype.drawElements = function(mode, count, type, offset, instances) {
+  if (this.ext) this.ext.drawElementsInstancedANGLE(mode, count, type, offset, instances);
+  else this.gl.drawElementsInstanced(mode, count, type, offset, instances);
+}
+
+// First of the four attribute locations taken by the per instance matrix.
+var INSTANCE_ATTRIBUTE = 3;
+
+// Attribute locations of the bone indices and weights of skinned meshes,
+// those of the instance matrix as skinned meshes aren't instanced. WebGL only
+// guarantees 8 attributes.
+var SKIN_ATTRIBUTE = INSTANCE_ATTRIBUTE;
+
+// Uniform buffer binding of the per frame uniform block on WebGL2.
+var FRAME_BLOCK_BINDING = 0;
+
+// Distance around a bounding box within which the eye counts as inside it,
+// at least the near plane distance so the box isn't clipped.
+var OCCLUSION_MARGIN = 1.5;
+
+// Unit cube drawn, scaled to the bounds, by occlusion queries.
+var BOX_VERTICES = [
+  0, 0, 0,  1, 0, 0,  1, 1, 0,  0, 1, 0,
+  0, 0, 1,  1, 0, 1,  1, 1, 1,  0, 1, 1
+];
+var BOX_INDICES = [
+  0, 2, 1,  0, 3, 2,  4, 5, 6,  4, 6, 7,
+  0, 1, 5,  0, 5, 4,  2, 3, 7,  2, 7, 6,
+  1, 2, 6,  1, 6, 5,  0, 4, 7,  0, 7, 3
+];
+
+// True if point is within margin of the world space box around the bounds
+// (min and max corner) transformed by matrix.
+function boxContains(bounds, matrix, point, margin) {
+  for (var i = 0; i < 3; i++) {
+    var center = matrix[12 + i], extent = margin;
+    for (var j = 0; j < 3; j++) {
+      var m = matrix[j * 4 + i];
+      center += m * (bounds[j] + bounds[j + 3]) * 0.5;
+      extent += Math.abs(m) * (bounds[j + 3] - bounds[j]) * 0.5;
+    }
+    if (Math.abs(point[i] - center) > extent) return false;
+  }
+  return true;
+}
+
+function maxIndex(indices) {
+  var max = 0;
+  for (var i = 0; i < indices.length; i++) {
+    if (indices[i] > max) max = indices[i];
+  }
+  return max;
+}
+
+// Returns data as a typed array of the given type, without copying if it
+// already is one.
+function typedArray(type, data) {
+  if (data instanceof type) return data;
+  return new type(data);
+}
+
 function BasicRenderer(params) {
 
   this.programs = [];
   this.params = params;
   this.canvas = document.getElementById(params['canvas id']);
 
-  // Init OpenGL.
+  // Init OpenGL, WebGL2 where available unless 'webgl2' is false.
   this.gl = null;
-  try { this.gl = this.canvas.getContext("webgl"); }
+  if (params['webgl2'] !== false) {
+    try { this.gl = this.canvas.getContext("webgl2"); }
+    catch (e) { }
+  }
+  this.webgl2 = this.gl ? true : false;
+  try { if (!this.gl) this.gl = this.canvas.getContext("webgl"); }
   catch (e) { }
   try { if (!this.gl) this.gl = this.canvas.getContext("moz-webgl"); }
   catch (e) { }
@@ -2141,6 +4385,27 @@ function BasicRenderer(params) {
     this.gl = WebGLDebugUtils.makeDebugContext(this.gl);
   }
 
+  // Extensions.
+  this.vertexArrays = new VertexArrays(this.gl);
+  log('vertex array objects: ' + this.vertexArrays.supported);
+  this.instancing = new Instancing(this.gl);
+  log('instancing: ' + this.instancing.supported);
+  this.uintIndices = this.webgl2 ||
+    (this.gl.getExtension('OES_element_index_uint') ? true : false);
+  log('32 bit indices: ' + this.uintIndices);
+  // Compressed texture formats by the names the exporter uses, preferred
+  // first. Getting the extension enables the formats.
+  this.textureFormats = [];
+  if (this.gl.getExtension('WEBGL_compressed_texture_s3tc') ||
+      this.gl.getExtension('MOZ_WEBGL_compressed_texture_s3tc') ||
+      this.gl.getExtension('WEBKIT_WEBGL_compressed_texture_s3tc')) {
+    this.textureFormats.push('dxt');
+  }
+  if (this.gl.getExtension('WEBGL_compressed_texture_etc1')) {
+    this.textureFormats.push('etc1');
+  }
+  log('compressed textures: ' + this.textureFormats.join(', '));
+
   // GL init.
   this.gl.clearColor(
     params['clear color'][0], params['clear color'][1],
@@ -2154,6 +4419,50 @@ function BasicRenderer(params) {
   this.gl.enableVertexAttribArray(1); // Texture coordinates.
   this.gl.enableVertexAttribArray(2); // Vertices.
 
+  // The instance matrix attribute is an identity constant unless an
+  // instanced mesh is being drawn.
+  this.gl.vertexAttrib4f(INSTANCE_ATTRIBUTE + 0, 1, 0, 0, 0);
+  this.gl.vertexAttrib4f(INSTANCE_ATTRIBUTE + 1, 0, 1, 0, 0);
+  this.gl.vertexAttrib4f(INSTANCE_ATTRIBUTE + 2, 0, 0, 1, 0);
+  this.gl.vertexAttrib4f(INSTANCE_ATTRIBUTE + 3, 0, 0, 0, 1);
+
+  // Counters.
+  this.stats = resetStats({});
+  this.frameStats = resetStats({});
+  // Buffer uploads happen between frames, they are reported with the next.
+  this.uploadedBytes = 0;
+
+  // Bumped whenever frame constant uniforms (projection, camera and normal
+  // matrices) may have changed, see renderMesh().
+  this.uniformEpoch = 0;
+
+  // Meshes of drawListScene in drawing order, rebuilt when meshes were
+  // added or removed, see render().
+  this.drawList = [];
+  this.drawListScene = null;
+  this.drawListDirty = true;
+  // Meshes with a parent or children, parents first, see updateTransforms().
+  this.transformList = [];
+  this.transformsDirty = false;
+
+  // Occlusion culling of meshes with bounds, WebGL2 only. Meshes to test
+  // this frame and meshes whose query results are outstanding, see
+  // testOcclusion().
+  this.occlusion = this.webgl2 && params['occlusion culling'] ? true : false;
+  this.occlusionList = [];
+  this.occlusionPending = [];
+  this.inverseCamera = mat4.create();
+  this.eye = vec3.create();
+
+  // Frame scheduler state, see run().
+  this.running = false;
+  this.dirty = true;
+  this.framePending = false;
+
+  // Texture uploads waiting for a frame, see uploadTextures().
+  this.textureUploads = [];
+  this.textureUploadBudget = params['texture upload budget'] || 4;
+
   // Init camera.
   this.camerastack = [];
   this.camerastacklen = 0;
@@ -2162,13 +4471,33 @@ function BasicRenderer(params) {
   mat4.lookAt([0, -5, 4], [0, 1, 0], [0, 1, 0], camera);
   log('camera: ' + mat4.str(camera));
   this.pushCamera(camera);
+  // Scratch for the normal matrix, see render().
+  this.inverseCamera3 = mat3.create();
+
+  // On WebGL2 the frame constant uniforms of every program live in one
+  // uniform buffer: projection, camera and normal matrices (std140).
+  if (this.webgl2) {
+    this.frameData = new Float32Array(48);
+    this.frameBuffer = this.gl.createBuffer();
+    this.gl.bindBuffer(this.gl.UNIFORM_BUFFER, this.frameBuffer);
+    this.gl.bufferData(this.gl.UNIFORM_BUFFER, this.frameData.byteLength, this.gl.DYNAMIC_DRAW);
+    this.gl.bindBufferBase(this.gl.UNIFORM_BUFFER, FRAME_BLOCK_BINDING, this.frameBuffer);
+    this.gl.bindBuffer(this.gl.UNIFORM_BUFFER, null);
+    this.frameBufferEpoch = -1;
+  }
+  log('webgl2: ' + this.webgl2);
 
   // Init shaders.
   this.gl.program = this.newProgram(
-    params['vertex program id'], params['fragment program id']
+    this.programID('vertex program id'), this.programID('fragment program id')
   );
 }
 
+// Shader id param name, its 'webgl2 ' variant on WebGL2 if given.
+BasicRenderer.prototype.programID = function(name) {
+  return this.webgl2 && this.params['webgl2 ' + name] || this.params[name];
+}
+
 BasicRenderer.prototype.reshape = function() {
   this.width = this.canvas.clientWidth;
   this.height = this.canvas.clientHeight;
@@ -2182,6 +4511,7 @@ BasicRenderer.prototype.reshape = function() {
   log('projection1: ' + mat4.str(projection));
   this.pushProjection(projection);
   log('projection2: ' + mat4.str(this.projection()));
+  this.invalidate();
 }
 
 BasicRenderer.prototype.newProgram = function(vprogid, fprogid) {
@@ -2196,6 +4526,10 @@ BasicRenderer.prototype.newProgram = function(vprogid, fprogid) {
   for (var i in attributes) {
     this.gl.bindAttribLocation (program.shader, parseInt(i), attributes[i]);
   }
+  var skinattributes = this.params['skinning attribute names'] || [];
+  for (var i = 0; i < skinattributes.length; i++) {
+    this.gl.bindAttribLocation (program.shader, SKIN_ATTRIBUTE + i, skinattributes[i]);
+  }
   this.gl.linkProgram(program.shader);
   var linked = this.gl.getProgramParameter(program.shader, this.gl.LINK_STATUS);
   if (!linked) {
@@ -2228,14 +4562,38 @@ BasicRenderer.prototype.newProgram = function(vprogid, fprogid) {
   program.u_objectMatrixLoc = this.gl.getUniformLocation(
     program.shader, this.params['object matrix variable']
   );
+  program.u_bonesLoc = this.gl.getUniformLocation(
+    program.shader, this.params['bones variable']
+  );
+  program.u_boxMinLoc = this.gl.getUniformLocation(
+    program.shader, this.params['box min variable']
+  );
+  program.u_boxSizeLoc = this.gl.getUniformLocation(
+    program.shader, this.params['box size variable']
+  );
+  program.frameBlock = false;
+  if (this.webgl2) {
+    var block = this.gl.getUniformBlockIndex(
+      program.shader, this.params['frame block name'] || 'Frame'
+    );
+    if (block != this.gl.INVALID_INDEX) {
+      this.gl.uniformBlockBinding(program.shader, block, FRAME_BLOCK_BINDING);
+      program.frameBlock = true;
+    }
+  }
   program.normalMatrix = mat4.create();
   mat4.identity(program.normalMatrix);
+  program.uniformEpoch = -1;
+  program.objectMatrix = mat4.create();
+  program.objectMatrixValid = false;
   this.programs[this.programs.length] = program;
   return program;
 }
 
 BasicRenderer.prototype.pushCamera = function(camera) {
   this.camerastack[this.camerastacklen++] = camera;
+  this.uniformEpoch++;
+  this.invalidate();
 }
 
 BasicRenderer.prototype.camera = function() {
@@ -2246,11 +4604,15 @@ BasicRenderer.prototype.popCamera = function() {
   var idx = --this.camerastacklen;
   var rcamera = this.camerastack[idx];
   delete this.camerastack[idx];
+  this.uniformEpoch++;
+  this.invalidate();
   return rcamera;
 }
 
 BasicRenderer.prototype.pushProjection = function(projection) {
   this.projectionstack[this.projectionstacklen++] = projection;
+  this.uniformEpoch++;
+  this.invalidate();
 }
 
 BasicRenderer.prototype.projection = function() {
@@ -2261,6 +4623,8 @@ BasicRenderer.prototype.popProjection = function() {
   var idx = --this.projectionstacklen;
   var rprojection = this.projectionstack[idx];
   delete this.projectionstack[idx];
+  this.uniformEpoch++;
+  this.invalidate();
   return rprojection;
 }
 
@@ -2273,6 +4637,8 @@ BasicRenderer.prototype.getShader = function(id) {
     if (k.nodeType == 3) str += k.textContent;
     k = k.nextSibling;
   }
+  // A #version line must come first.
+  str = str.replace(/^\\s+/, '');
   var shader;
   if (shaderScript.type == "x-shader/x-fragment") {
     shader = this.gl.createShader(this.gl.FRAGMENT_SHADER);
@@ -2293,20 +4659,108 @@ BasicRenderer.prototype.getShader = function(id) {
   return shader;
 }
 
-BasicRenderer.prototype.standardTexture = function(image, args) {
+// args are [gl] or [gl, renderer]. image is an image or a compressed texture
+// from the loader, or an exported placeholder { width, height, pixels } with
+// base64 RGBA pixels. info, when given, describes an exported mip chain:
+// 'levels' power of two levels side by side from the left of image, level 0
+// 'width' x 'height', and whether the texture may 'repeat'. texture is the
+// placeholder image replaces, it is reused so meshes keep drawing it. With a
+// renderer, images are uploaded over its next frames, see uploadTextures().
+BasicRenderer.prototype.standardTexture = function(image, args, info, texture) {
   var gl = args[0];
-  var texture = gl.createTexture();
-  texture.image = image;
-  texture.target = gl.TEXTURE_2D;
+  var renderer = args[1];
+  if (!texture) {
+    texture = gl.createTexture();
+    texture.target = gl.TEXTURE_2D;
+    texture.ready = false;
+  }
+  if (renderer && !image.pixels) {
+    if (image.timing) image.timing.deferred = true;
+    renderer.textureUploads.push({
+      texture: texture, image: image, info: info, timing: image.timing
+    });
+    renderer.invalidate();
+  }
+  else {
+    uploadTexture(gl, texture, image, info);
+  }
+  return texture;
+}
+
+// Uploads queued textures until the frame's 'texture upload budget' in
+// milliseconds is spent, at least one per frame. The time each takes is
+// reported to the loader's timing of the texture. The budget is checked
+// between textures only, a texture is always uploaded whole, so one large
+// texture can still take longer than the budget in its frame.
+BasicRenderer.prototype.uploadTextures = function() {
+  var start = now();
+  var uploads = this.textureUploads;
+  var count = 0;
+  do {
+    var upload = uploads[count++];
+    var uploadstart = now();
+    uploadTexture(this.gl, upload.texture, upload.image, upload.info);
+    if (upload.timing) {
+      upload.timing.upload = now() - uploadstart;
+      upload.timing.uploaded();
+    }
+  } while (count < uploads.length && now() - start < this.textureUploadBudget);
+  uploads.splice(0, count);
+  lastboundtexture = false;
+}
+
+// Specifies texture's levels from image, see standardTexture().
+function uploadTexture(gl, texture, image, info) {
+  texture.image = image;
   gl.bindTexture(gl.TEXTURE_2D, texture);
-  gl.texImage2D(gl.TEXTURE_2D, 0, gl.RGBA, gl.RGBA, gl.UNSIGNED_BYTE, texture.image);
+  var mipmapped = false;
+  if (image.pixels) {
+    var bytes = atob(image.pixels);
+    var pixels = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) pixels[i] = bytes.charCodeAt(i);
+    gl.texImage2D(
+      gl.TEXTURE_2D, 0, gl.RGBA, image.width, image.height, 0,
+      gl.RGBA, gl.UNSIGNED_BYTE, pixels
+    );
+  }
+  else if (image.compressed) {
+    var width = image.width, height = image.height;
+    for (var level = 0; level < image.levels.length; level++) {
+      gl.compressedTexImage2D(
+        gl.TEXTURE_2D, level, image.format, width, height, 0, image.levels[level]
+      );
+      width = Math.max(1, width >> 1);
+      height = Math.max(1, height >> 1);
+    }
+    mipmapped = image.levels.length > 1;
+  }
+  else if (info && info['levels'] > 1) {
+    var canvas = document.createElement('canvas');
+    var context = canvas.getContext('2d');
+    var x = 0, width = info['width'], height = info['height'];
+    for (var level = 0; level < info['levels']; level++) {
+      canvas.width = width;
+      canvas.height = height;
+      context.drawImage(image, x, 0, width, height, 0, 0, width, height);
+      gl.texImage2D(gl.TEXTURE_2D, level, gl.RGBA, gl.RGBA, gl.UNSIGNED_BYTE, canvas);
+      x += width;
+      width = Math.max(1, width >> 1);
+      height = Math.max(1, height >> 1);
+    }
+    mipmapped = true;
+  }
+  else {
+    gl.texImage2D(gl.TEXTURE_2D, 0, gl.RGBA, gl.RGBA, gl.UNSIGNED_BYTE, texture.image);
+  }
+  // Only exported power of two textures may repeat.
+  var wrap = info && info['repeat'] ? gl.REPEAT : gl.CLAMP_TO_EDGE;
   gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MAG_FILTER, gl.LINEAR);
-  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.LINEAR);
-  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
-  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
-  //gl.generateMipmap(gl.TEXTURE_2D);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER,
+    mipmapped ? gl.LINEAR_MIPMAP_LINEAR : gl.LINEAR);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, wrap);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, wrap);
   gl.bindTexture(gl.TEXTURE_2D, null);
-  return texture;
+  texture.ready = true;
 }
 
 BasicRenderer.prototype.standardVBO = function(data, args) {
@@ -2332,36 +4786,178 @@ BasicRenderer.prototype.standardVBO = function(data, args) {
     vbo.texcoordsObject = null;
   }
 
+  // Bone indices and weights buffers of skinned meshes.
+  vbo.bonesData = data["bones"];
+  if (vbo.bonesData) {
+    vbo.bonesObject = gl.createBuffer();
+    vbo.weightsData = data["weights"];
+    vbo.weightsObject = gl.createBuffer();
+  }
+
   // Index buffer.
   vbo.indicesData = data["indices"];
   vbo.indicesObject = gl.createBuffer();
 
   renderer.updateVBO(vbo);
-  
+  renderer.recordVertexArray(vbo);
+  if (data["ranges"]) vbo.setRanges(data["ranges"]);
+
+  return vbo;
+}
+
+// Record the attribute setup once, binding the VBO is then a single call.
+BasicRenderer.prototype.recordVertexArray = function(vbo) {
+  var gl = this.gl;
+  if (!this.vertexArrays.supported) return;
+  vbo.vertexArrays = this.vertexArrays;
+  vbo.vao = this.vertexArrays.create();
+  this.vertexArrays.bind(vbo.vao);
+  gl.enableVertexAttribArray(0);
+  if (vbo.texcoordsObject) gl.enableVertexAttribArray(1);
+  gl.enableVertexAttribArray(2);
+  vbo.setupAttributes(gl);
+  this.vertexArrays.bind(null);
+  lastboundvbo = false;
+}
+
+// VBO for a progressive mesh stream (see JQueryLoader.loadMeshStream). The
+// buffers are allocated at full size up front and nothing is drawn until the
+// first level arrives, every level then refines the mesh in place. Without
+// 32 bit index support a stream of more than 65536 vertices only gets as far
+// as its last level with 16 bit indices.
+BasicRenderer.prototype.streamVBO = function(stream, args) {
+  var renderer = args[0];
+  var gl = renderer.gl;
+  var vbo = new StandardVBO();
+  vbo.vertexData = new Float32Array(stream.vertexCount * 3);
+  vbo.vertexObject = gl.createBuffer();
+  vbo.normalsData = new Float32Array(stream.vertexCount * 3);
+  vbo.normalsObject = gl.createBuffer();
+  vbo.texcoordsData = new Float32Array(stream.vertexCount * 2);
+  vbo.texcoordsObject = gl.createBuffer();
+  if (stream.uint32Indices && renderer.uintIndices) {
+    vbo.indicesData = new Uint32Array(stream.indexCount);
+  }
+  else {
+    vbo.indicesData = new Uint16Array(stream.indexCount);
+  }
+  vbo.indicesObject = gl.createBuffer();
+  renderer.updateVBO(vbo);
+  renderer.recordVertexArray(vbo);
+  vbo.vertexCount = 0;
+  vbo.streaming = true;
+  stream.onlevel = function(level) {
+    renderer.refineVBO(vbo, level);
+  };
   return vbo;
 }
 
+BasicRenderer.prototype.refineVBO = function(vbo, level) {
+  var first = level.firstVertex;
+  if (first + level.vertexCount > 65536 && !(vbo.indicesData instanceof Uint32Array)) {
+    if (!vbo.truncated) log('stream level ' + level.index + ' not drawn, 32 bit indices are not supported');
+    vbo.truncated = true;
+    return;
+  }
+  vbo.vertexData.set(level.vertices, first * 3);
+  vbo.markDirty('vertices', first * 3, first * 3 + level.vertices.length);
+  vbo.normalsData.set(level.normals, first * 3);
+  vbo.markDirty('normals', first * 3, first * 3 + level.normals.length);
+  vbo.texcoordsData.set(level.texcoords, first * 2);
+  vbo.markDirty('texcoords', first * 2, first * 2 + level.texcoords.length);
+  vbo.indicesData.set(level.indices, 0);
+  vbo.markDirty('indices', 0, level.indices.length);
+  this.updateVBO(vbo);
+  vbo.vertexCount = level.indices.length;
+  if (level.ranges) vbo.setRanges(level.ranges);
+  if (level.last) vbo.streaming = false;
+  this.invalidate();
+}
+
+// Uploads the VBO's arrays, converted to typed arrays once. A buffer is
+// allocated with bufferData for an array it didn't hold before, and for
+// dynamic VBOs when all of it changed, which orphans the storage the GPU may
+// still be drawing from. Otherwise only the spans marked with markDirty()
+// are uploaded, with bufferSubData.
 BasicRenderer.prototype.updateVBO = function(vbo) {
   var gl = this.gl;
-  vbo.vertices = new Float32Array(vbo.vertexData);
-  gl.bindBuffer(gl.ARRAY_BUFFER, vbo.vertexObject);
-  gl.bufferData(gl.ARRAY_BUFFER, vbo.vertices, gl.STATIC_DRAW);
-  vbo.normals = new Float32Array(vbo.normalsData);
-  gl.bindBuffer(gl.ARRAY_BUFFER, vbo.normalsObject);
-  gl.bufferData(gl.ARRAY_BUFFER, vbo.normals, gl.STATIC_DRAW);
+  if (this.vertexArrays.supported) {
+    // Buffer bindings below would otherwise end up in the bound VAO.
+    this.vertexArrays.bind(null);
+    lastboundvbo = false;
+  }
+  vbo.vertices = vbo.vertexData = typedArray(Float32Array, vbo.vertexData);
+  this.uploadBuffer(vbo, gl.ARRAY_BUFFER, vbo.vertexObject, 'vertices', vbo.vertices);
+  vbo.normals = vbo.normalsData = typedArray(Float32Array, vbo.normalsData);
+  this.uploadBuffer(vbo, gl.ARRAY_BUFFER, vbo.normalsObject, 'normals', vbo.normals);
   if (vbo.texcoordsData) {
-    vbo.texcoords = new Float32Array(vbo.texcoordsData);
-    gl.bindBuffer(gl.ARRAY_BUFFER, vbo.texcoordsObject);
-    gl.bufferData(gl.ARRAY_BUFFER, vbo.texcoords, gl.STATIC_DRAW);
+    vbo.texcoords = vbo.texcoordsData = typedArray(Float32Array, vbo.texcoordsData);
+    this.uploadBuffer(vbo, gl.ARRAY_BUFFER, vbo.texcoordsObject, 'texcoords', vbo.texcoords);
+  }
+  if (vbo.bonesData) {
+    vbo.bones = vbo.bonesData = typedArray(Uint8Array, vbo.bonesData);
+    this.uploadBuffer(vbo, gl.ARRAY_BUFFER, vbo.bonesObject, 'bones', vbo.bones);
+    vbo.weights = vbo.weightsData = typedArray(Uint8Array, vbo.weightsData);
+    this.uploadBuffer(vbo, gl.ARRAY_BUFFER, vbo.weightsObject, 'weights', vbo.weights);
   }
   gl.bindBuffer(gl.ARRAY_BUFFER, null);
-  vbo.indices = new Uint16Array(vbo.indicesData);
-  gl.bindBuffer(gl.ELEMENT_ARRAY_BUFFER, vbo.indicesObject);
-  gl.bufferData(gl.ELEMENT_ARRAY_BUFFER, vbo.indices, gl.STATIC_DRAW);
+  var wide = vbo.indicesData instanceof Uint32Array;
+  if (wide && !this.uintIndices || !vbo.indicesData.BYTES_PER_ELEMENT) {
+    // JSON meshes of more than 65536 vertices, or 32 bit indices from the
+    // worker or a stream without OES_element_index_uint.
+    if (maxIndex(vbo.indicesData) <= 65535) {
+      if (wide) vbo.indicesData = new Uint16Array(vbo.indicesData);
+    }
+    else if (!this.uintIndices) {
+      log('mesh not drawn, 32 bit indices are not supported');
+      vbo.indicesData = [];
+    }
+    else {
+      vbo.indicesData = new Uint32Array(vbo.indicesData);
+    }
+  }
+  if (vbo.indicesData instanceof Uint32Array) {
+    vbo.indices = vbo.indicesData;
+    vbo.indexType = gl.UNSIGNED_INT;
+  }
+  else {
+    vbo.indices = vbo.indicesData = typedArray(Uint16Array, vbo.indicesData);
+    vbo.indexType = gl.UNSIGNED_SHORT;
+  }
+  this.uploadBuffer(vbo, gl.ELEMENT_ARRAY_BUFFER, vbo.indicesObject, 'indices', vbo.indices);
   gl.bindBuffer(gl.ELEMENT_ARRAY_BUFFER, null);
   vbo.vertexCount = vbo.indicesData.length;
 }
 
+BasicRenderer.prototype.uploadBuffer = function(vbo, target, buffer, name, array) {
+  var gl = this.gl;
+  var span = vbo.dirty[name];
+  var changed = span && span.first < span.end;
+  if (vbo.uploaded[name] === array && !changed) return;
+  gl.bindBuffer(target, buffer);
+  if (vbo.uploaded[name] !== array ||
+      vbo.dynamic && span.first <= 0 && span.end >= array.length) {
+    gl.bufferData(target, array, vbo.dynamic ? gl.DYNAMIC_DRAW : gl.STATIC_DRAW);
+    vbo.uploaded[name] = array;
+    this.countUpload(array.byteLength);
+  }
+  else {
+    // Animated meshes tend to change the same span every frame, its view is
+    // kept instead of allocating a new one.
+    if (span.view && span.view.buffer === array.buffer && span.viewFirst == span.first &&
+        span.view.length == span.end - span.first) {
+      var view = span.view;
+    }
+    else {
+      var view = span.view = array.subarray(span.first, span.end);
+      span.viewFirst = span.first;
+    }
+    gl.bufferSubData(target, span.first * array.BYTES_PER_ELEMENT, view);
+    this.countUpload(view.byteLength);
+  }
+  if (span) span.first = span.end = 0;
+}
+
 BasicRenderer.prototype.renderMesh = function(mesh) {
   if (mesh.program) {
     var program = mesh.program;
@@ -2379,128 +4975,966 @@ BasicRenderer.prototype.renderMesh = function(mesh) {
     if (!mesh.vbo.bind(this.gl)) return;
     lastboundvbo = mesh.vbo.id;
   }
-  if (mesh.texture != lastboundtexture) {
-    if (lastboundtexture) {
-      renderer.gl.bindTexture(lastboundtexture.target, null);
-    }
-    this.gl.bindTexture(mesh.texture.target, mesh.texture);
-    lastboundtexture = mesh.texture;
-  }
   //log('camera: ' + mat4.str(this.camera()));
   //log('projection: ' + mat4.str(this.projection()));
+  this.uploadFrameUniforms(program);
+  if (mesh.skin) {
+    this.gl.uniform4fv(program.u_bonesLoc, mesh.skin.rows);
+    this.count('uniform uploads', 1);
+  }
+  var ranges = mesh.vbo.ranges;
+  if (mesh.rangeTextureIDs && ranges) {
+    // One draw per range with its texture, the VBO stays bound.
+    var size = mesh.vbo.indexType == this.gl.UNSIGNED_INT ? 4 : 2;
+    for (var r = 0; r < ranges.length; r++) {
+      var texture = mesh.rangeTextures[r];
+      if (mesh.rangeTextureIDs[r] && !(texture && texture.ready)) continue;
+      if (!ranges[r].count) continue;
+      this.bindTexture(texture);
+      this.drawMesh(program, mesh, ranges[r].count, ranges[r].first * size);
+    }
+    return;
+  }
+  this.bindTexture(mesh.texture);
+  this.drawMesh(program, mesh, mesh.vbo.vertexCount, 0);
+}
+
+BasicRenderer.prototype.bindTexture = function(texture) {
+  if (texture == lastboundtexture) return;
+  if (lastboundtexture) {
+    this.gl.bindTexture(lastboundtexture.target, null);
+  }
+  if (texture) {
+    this.gl.bindTexture(texture.target, texture);
+  }
+  lastboundtexture = texture;
+}
+
+// Draws count indices from byte offset of mesh's bound VBO.
+BasicRenderer.prototype.drawMesh = function(program, mesh, count, offset) {
+  if (mesh.instanceCount) {
+    this.renderInstances(program, mesh, count, offset);
+    return;
+  }
+  this.uploadObjectMatrix(program, mesh.objectMatrix);
+  this.gl.drawElements(this.gl.TRIANGLES, count, mesh.vbo.indexType, offset);
+  this.count('draw calls', 1);
+}
+
+BasicRenderer.prototype.renderInstances = function(program, mesh, count, offset) {
+  var gl = this.gl;
+  if (!this.instancing.supported) {
+    // One draw per instance.
+    for (var i = 0; i < mesh.instanceCount; i++) {
+      this.uploadObjectMatrix(program, mesh.instanceObjectMatrices[i]);
+      gl.drawElements(gl.TRIANGLES, count, mesh.vbo.indexType, offset);
+    }
+    this.count('draw calls', mesh.instanceCount);
+    return;
+  }
+  this.uploadObjectMatrix(program, mesh.objectMatrix);
+  gl.bindBuffer(gl.ARRAY_BUFFER, mesh.instanceObject);
+  for (var i = 0; i < 4; i++) {
+    gl.enableVertexAttribArray(INSTANCE_ATTRIBUTE + i);
+    gl.vertexAttribPointer(INSTANCE_ATTRIBUTE + i, 4, gl.FLOAT, false, 64, i * 16);
+    this.instancing.divisor(INSTANCE_ATTRIBUTE + i, 1);
+  }
+  this.instancing.drawElements(
+    gl.TRIANGLES, count, mesh.vbo.indexType, offset, mesh.instanceCount
+  );
+  for (var i = 0; i < 4; i++) {
+    this.instancing.divisor(INSTANCE_ATTRIBUTE + i, 0);
+    gl.disableVertexAttribArray(INSTANCE_ATTRIBUTE + i);
+  }
+  this.count('draw calls', 1);
+}
+
+// Frame constant uniforms are uploaded once per program per uniform epoch.
+BasicRenderer.prototype.uploadFrameUniforms = function(program) {
+  if (program.uniformEpoch == this.uniformEpoch) {
+    this.count('uniform uploads saved', 3);
+    return;
+  }
+  program.uniformEpoch = this.uniformEpoch;
+  if (program.frameBlock) {
+    // Shared by all programs, one upload per epoch.
+    if (this.frameBufferEpoch == this.uniformEpoch) {
+      this.count('uniform uploads saved', 3);
+      return;
+    }
+    this.frameData.set(this.projection(), 0);
+    this.frameData.set(this.camera(), 16);
+    this.frameData.set(program.normalMatrix, 32);
+    this.gl.bindBuffer(this.gl.UNIFORM_BUFFER, this.frameBuffer);
+    this.gl.bufferSubData(this.gl.UNIFORM_BUFFER, 0, this.frameData);
+    this.gl.bindBuffer(this.gl.UNIFORM_BUFFER, null);
+    this.frameBufferEpoch = this.uniformEpoch;
+    this.count('uniform uploads', 1);
+    return;
+  }
   this.gl.uniformMatrix4fv(program.u_projMatrixLoc, false, this.projection());
   this.gl.uniformMatrix4fv(program.u_modelViewMatrixLoc, false, this.camera());
-  this.gl.uniformMatrix4fv(program.u_objectMatrixLoc, false, mesh.objectMatrix);
   this.gl.uniformMatrix4fv(program.u_normalMatrixLoc, false, program.normalMatrix);
-  this.gl.drawElements(this.gl.TRIANGLES, mesh.vbo.vertexCount, this.gl.UNSIGNED_SHORT, 0);
+  this.count('uniform uploads', 3);
 }
 
+// Per object uniforms are only uploaded when they differ from the value the
+// program already holds.
+BasicRenderer.prototype.uploadObjectMatrix = function(program, matrix) {
+  if (program.objectMatrixValid && matrixEquals(program.objectMatrix, matrix)) {
+    this.count('uniform uploads saved', 1);
+    return;
+  }
+  this.gl.uniformMatrix4fv(program.u_objectMatrixLoc, false, matrix);
+  mat4.set(matrix, program.objectMatrix);
+  program.objectMatrixValid = true;
+  this.count('uniform uploads', 1);
+}
+
+BasicRenderer.prototype.count = function(name, n) {
+  this.stats[name] += n;
+  this.frameStats[name] += n;
+}
+
+BasicRenderer.prototype.countUpload = function(bytes) {
+  this.stats['buffer bytes uploaded'] += bytes;
+  this.uploadedBytes += bytes;
+}
+
+// Local matrix translate * rotate z * rotate y * rotate x * scale, written
+// in place without allocating. It is the object matrix of meshes without a
+// parent, updateTransforms() computes the others.
 BasicRenderer.prototype.setObjectMatrix = function(mesh) {
-  if (!mesh.objectMatrix) {
-    mesh.objectMatrix = mat4.create();
+  if (!mesh.localMatrix) {
+    mesh.localMatrix = mat4.create();
+    // Without a parent the local matrix is the object matrix.
+    mesh.objectMatrix = mesh.parent ? mat4.create() : mesh.localMatrix;
+  }
+  var m = mesh.localMatrix;
+  var t = mesh.translate, r = mesh.rotate, s = mesh.scale;
+  var d = Math.PI / 180.0;
+  var cx = Math.cos(r[0] * d), sx = Math.sin(r[0] * d);
+  var cy = Math.cos(r[1] * d), sy = Math.sin(r[1] * d);
+  var cz = Math.cos(r[2] * d), sz = Math.sin(r[2] * d);
+  m[0] = cz * cy * s[0];
+  m[1] = sz * cy * s[0];
+  m[2] = -sy * s[0];
+  m[3] = 0;
+  m[4] = (cz * sy * sx - sz * cx) * s[1];
+  m[5] = (sz * sy * sx + cz * cx) * s[1];
+  m[6] = cy * sx * s[1];
+  m[7] = 0;
+  m[8] = (cz * sy * cx + sz * sx) * s[2];
+  m[9] = (sz * sy * cx - cz * sx) * s[2];
+  m[10] = cy * cx * s[2];
+  m[11] = 0;
+  m[12] = t[0];
+  m[13] = t[1];
+  m[14] = t[2];
+  m[15] = 1;
+  mesh.transformDirty = true;
+  this.transformsDirty = true;
+}
+
+// Object matrices of the meshes in transformList, parents first: parent
+// object matrix * parent inverse * local matrix. Only meshes whose own or an
+// ancestor's local matrix changed since the last update are recomputed.
+BasicRenderer.prototype.updateTransforms = function() {
+  var list = this.transformList;
+  for (var i = 0; i < list.length; i++) {
+    var node = list[i];
+    var parent = node.parentNode;
+    var changed = node.transformDirty || (parent != null && parent.transformChanged);
+    node.transformDirty = false;
+    node.transformChanged = changed;
+    if (!changed) continue;
+    if (!parent) {
+      // Its parent is not in the scene.
+      if (node.objectMatrix !== node.localMatrix) mat4.set(node.localMatrix, node.objectMatrix);
+      continue;
+    }
+    if (node.parentInverse) {
+      mat4.multiply(parent.objectMatrix, node.parentInverse, node.objectMatrix);
+      mat4.multiply(node.objectMatrix, node.localMatrix, node.objectMatrix);
+    }
+    else {
+      mat4.multiply(parent.objectMatrix, node.localMatrix, node.objectMatrix);
+    }
+  }
+  this.transformsDirty = false;
+}
+
+// Builds the per instance matrices of a mesh with exported "instances", nine
+// values (translate, rotate, scale) per instance.
+BasicRenderer.prototype.setInstanceMatrices = function(mesh) {
+  var gl = this.gl;
+  var count = mesh.instances.length / 9;
+  var instance = { "translate": [0, 0, 0], "rotate": [0, 0, 0], "scale": [1, 1, 1] };
+  mesh.instanceCount = count;
+  mesh.instanceMatrices = new Float32Array(count * 16);
+  for (var i = 0; i < count; i++) {
+    for (var j = 0; j < 3; j++) {
+      instance.translate[j] = mesh.instances[i * 9 + j];
+      instance.rotate[j] = mesh.instances[i * 9 + 3 + j];
+      instance.scale[j] = mesh.instances[i * 9 + 6 + j];
+    }
+    this.setObjectMatrix(instance);
+    mesh.instanceMatrices.set(instance.objectMatrix, i * 16);
+  }
+  if (this.instancing.supported) {
+    mesh.instanceObject = gl.createBuffer();
+    gl.bindBuffer(gl.ARRAY_BUFFER, mesh.instanceObject);
+    gl.bufferData(gl.ARRAY_BUFFER, mesh.instanceMatrices, gl.STATIC_DRAW);
+    this.countUpload(mesh.instanceMatrices.byteLength);
+    gl.bindBuffer(gl.ARRAY_BUFFER, null);
+    lastboundvbo = false;
+  }
+  else {
+    mesh.instanceObjectMatrices = [];
+    for (var i = 0; i < count; i++) {
+      var matrix = mat4.create();
+      mat4.multiply(mesh.objectMatrix, mesh.instanceMatrices.subarray(i * 16, i * 16 + 16), matrix);
+      mesh.instanceObjectMatrices[i] = matrix;
+    }
   }
-  mat4.identity(mesh.objectMatrix);
-  mat4.translate(mesh.objectMatrix, [mesh.translate[0], mesh.translate[1], mesh.translate[2]]);
-  mat4.rotate(mesh.objectMatrix, mesh.rotate[2] * Math.PI / 180.0, [0.0, 0.0, 1.0]);
-  mat4.rotate(mesh.objectMatrix, mesh.rotate[1] * Math.PI / 180.0, [0.0, 1.0, 0.0]);
-  mat4.rotate(mesh.objectMatrix, mesh.rotate[0] * Math.PI / 180.0, [1.0, 0.0, 0.0]);
-  mat4.scale(mesh.objectMatrix, [mesh.scale[0], mesh.scale[1], mesh.scale[2]]);
 }
 
 BasicRenderer.prototype.prepareMeshes = function(scene) {
-  for (i in scene.meshes) {
+  for (var i in scene.meshes) {
     var mesh = scene.meshes[i];
-    this.setObjectMatrix(mesh);
+    this.prepareMesh(scene, mesh);
     log(i + ': ' + mat4.str(mesh.objectMatrix));
-    mesh.texture = scene.textures[mesh.textureID];
   }
 }
 
-BasicRenderer.prototype.render = function(scene) {
-  var clear = true;
-  if (arguments.length > 1) {
-    clear = arguments[1];
+// Meshes can be prepared one at a time as they arrive, textures that are
+// not loaded yet are picked up by render().
+BasicRenderer.prototype.prepareMesh = function(scene, mesh) {
+  this.drawListDirty = true;
+  this.setObjectMatrix(mesh);
+  mesh.texture = scene.textures[mesh.textureID];
+  if (mesh.instances && !mesh.instanceMatrices) {
+    this.setInstanceMatrices(mesh);
+  }
+  if (mesh.morphs && mesh.vbo) this.updateMorphs(mesh);
+  if (mesh.skeleton && !mesh.skin && mesh.vbo && mesh.vbo.bonesObject) {
+    mesh.skin = new Skin(mesh.skeleton);
+    mesh.skin.update();
+    mesh.program = this.skinningProgram();
+  }
+}
+
+// Blends the mesh's morph weights into its VBO. Only targets whose weight
+// changed are applied, as the difference to the blended weight, and only the
+// span of vertices they move is uploaded.
+BasicRenderer.prototype.updateMorphs = function(mesh) {
+  var morphs = mesh.morphs;
+  var vbo = mesh.vbo;
+  var weights = mesh.morphWeights;
+  var first = vbo.vertices.length, end = 0;
+  for (var t = 0; t < morphs.targets.length; t++) {
+    var change = weights[t] - morphs.applied[t];
+    if (!change) continue;
+    morphs.applied[t] = weights[t];
+    var target = morphs.targets[t];
+    var indices = target.indices;
+    if (!indices.length) continue;
+    var p = change * target.positionStep;
+    var n = change * target.normalStep;
+    for (var i = 0, j = 0; i < indices.length; i++, j += 3) {
+      var v = indices[i] * 3;
+      vbo.vertices[v] += p * target.positions[j];
+      vbo.vertices[v + 1] += p * target.positions[j + 1];
+      vbo.vertices[v + 2] += p * target.positions[j + 2];
+      vbo.normals[v] += n * target.normals[j];
+      vbo.normals[v + 1] += n * target.normals[j + 1];
+      vbo.normals[v + 2] += n * target.normals[j + 2];
+    }
+    first = Math.min(first, indices[0] * 3);
+    end = Math.max(end, indices[indices.length - 1] * 3 + 3);
+  }
+  if (first >= end) return;
+  if (!vbo.dynamic) {
+    // Reallocated once as DYNAMIC_DRAW.
+    vbo.dynamic = true;
+    first = 0;
+    end = vbo.vertices.length;
+  }
+  vbo.markDirty('vertices', first, end);
+  vbo.markDirty('normals', first, end);
+  this.updateVBO(vbo);
+}
+
+// The skinning program is built when the first skinned mesh arrives.
+BasicRenderer.prototype.skinningProgram = function() {
+  if (!this.skinProgram) {
+    this.skinProgram = this.newProgram(
+      this.programID('skinning vertex program id'), this.programID('fragment program id')
+    );
+    lastboundprogram = false;
+  }
+  return this.skinProgram;
+}
+
+// Program and unit cube VBO for drawing bounding boxes.
+BasicRenderer.prototype.occlusionProgram = function() {
+  if (!this.boxProgram) {
+    var gl = this.gl;
+    this.boxProgram = this.newProgram(
+      this.programID('occlusion vertex program id'),
+      this.programID('occlusion fragment program id')
+    );
+    lastboundprogram = false;
+    this.boxVertices = gl.createBuffer();
+    this.boxIndices = gl.createBuffer();
+    this.boxVAO = this.vertexArrays.create();
+    this.vertexArrays.bind(this.boxVAO);
+    gl.bindBuffer(gl.ARRAY_BUFFER, this.boxVertices);
+    gl.bufferData(gl.ARRAY_BUFFER, new Float32Array(BOX_VERTICES), gl.STATIC_DRAW);
+    gl.enableVertexAttribArray(2);
+    gl.vertexAttribPointer(2, 3, gl.FLOAT, false, 0, 0);
+    gl.bindBuffer(gl.ELEMENT_ARRAY_BUFFER, this.boxIndices);
+    gl.bufferData(gl.ELEMENT_ARRAY_BUFFER, new Uint16Array(BOX_INDICES), gl.STATIC_DRAW);
+    this.vertexArrays.bind(null);
+    gl.bindBuffer(gl.ARRAY_BUFFER, null);
+    lastboundvbo = false;
+  }
+  return this.boxProgram;
+}
+
+// Draws the bounding boxes of the meshes in occlusionList with an occlusion
+// query each, after the visible meshes so they are tested against their
+// depth. Color and depth writes are off. The results are read in later
+// frames by pollOcclusion(), a mesh found hidden is skipped by render()
+// until a query of its box passes again, so the draw never waits for the
+// GPU.
+BasicRenderer.prototype.testOcclusion = function() {
+  var gl = this.gl;
+  var program = this.occlusionProgram();
+  var list = this.occlusionList;
+  var pending = this.occlusionPending;
+  gl.useProgram(program.shader);
+  lastboundprogram = program.id;
+  this.vertexArrays.bind(this.boxVAO);
+  lastboundvbo = false;
+  this.uploadFrameUniforms(program);
+  gl.colorMask(false, false, false, false);
+  gl.depthMask(false);
+  for (var i = 0; i < list.length; i++) {
+    var mesh = list[i];
+    var b = mesh.bounds;
+    this.uploadObjectMatrix(program, mesh.objectMatrix);
+    gl.uniform3f(program.u_boxMinLoc, b[0], b[1], b[2]);
+    gl.uniform3f(program.u_boxSizeLoc, b[3] - b[0], b[4] - b[1], b[5] - b[2]);
+    gl.beginQuery(gl.ANY_SAMPLES_PASSED_CONSERVATIVE, mesh.occlusionQuery);
+    gl.drawElements(gl.TRIANGLES, BOX_INDICES.length, gl.UNSIGNED_SHORT, 0);
+    gl.endQuery(gl.ANY_SAMPLES_PASSED_CONSERVATIVE);
+    mesh.queryPending = true;
+    pending[pending.length] = mesh;
+  }
+  this.count('occlusion queries', list.length);
+  list.length = 0;
+  gl.colorMask(true, true, true, true);
+  gl.depthMask(true);
+  this.vertexArrays.bind(null);
+}
+
+// Reads the query results that are available, returns true if a mesh's
+// visibility changed.
+BasicRenderer.prototype.pollOcclusion = function() {
+  var gl = this.gl;
+  var pending = this.occlusionPending;
+  var changed = false;
+  var n = 0;
+  for (var i = 0; i < pending.length; i++) {
+    var mesh = pending[i];
+    if (!gl.getQueryParameter(mesh.occlusionQuery, gl.QUERY_RESULT_AVAILABLE)) {
+      pending[n++] = mesh;
+      continue;
+    }
+    var occluded = !gl.getQueryParameter(mesh.occlusionQuery, gl.QUERY_RESULT);
+    if (occluded != mesh.occluded) {
+      mesh.occluded = occluded;
+      changed = true;
+    }
+    mesh.queryPending = false;
+  }
+  pending.length = n;
+  return changed;
+}
+
+// Fraction of the occlusion tested meshes that weren't drawn, of the last
+// frame or of the given stats.
+BasicRenderer.prototype.occlusionSavings = function(stats) {
+  stats = stats || this.frameStats;
+  if (!stats['occlusion tests']) return 0;
+  return stats['occlusion culled'] / stats['occlusion tests'];
+}
+
+// Collects the scene's meshes into a dense array, so render() doesn't
+// iterate the mesh names every frame, and the meshes of its transform
+// hierarchy into transformList, ordered by depth.
+BasicRenderer.prototype.updateDrawList = function(scene) {
+  var list = this.drawList;
+  list.length = 0;
+  for (var name in scene.meshes) {
+    var mesh = scene.meshes[name];
+    mesh.parentNode = mesh.parent && scene.meshes[mesh.parent] || null;
+    mesh.hasChildren = false;
+    list[list.length] = mesh;
+  }
+  var transforms = this.transformList;
+  transforms.length = 0;
+  for (var i = 0; i < list.length; i++) {
+    var mesh = list[i];
+    // Transform only nodes, and parents whose meshes haven't arrived yet.
+    if (!mesh.localMatrix) this.setObjectMatrix(mesh);
+    mesh.depth = 0;
+    for (var node = mesh.parentNode; node; node = node.parentNode) {
+      node.hasChildren = true;
+      mesh.depth++;
+    }
   }
+  for (var i = 0; i < list.length; i++) {
+    var mesh = list[i];
+    if (!mesh.parent && !mesh.hasChildren) continue;
+    mesh.transformDirty = true;
+    transforms[transforms.length] = mesh;
+  }
+  transforms.sort(function(a, b) { return a.depth - b.depth; });
+  this.transformsDirty = transforms.length > 0;
+  this.drawListScene = scene;
+  this.drawListDirty = false;
+}
+
+BasicRenderer.prototype.render = function(scene, clear) {
+  if (clear === undefined) clear = true;
   if (clear) {
     this.gl.clear(this.gl.COLOR_BUFFER_BIT | this.gl.DEPTH_BUFFER_BIT);
   }
+  resetStats(this.frameStats);
+  this.frameStats['buffer bytes uploaded'] = this.uploadedBytes;
+  this.uploadedBytes = 0;
+  this.count('frames', 1);
+  this.uniformEpoch++;
   var camera = this.camera();
-  mat4.set(camera, this.gl.program.normalMatrix);
-  mat4.toInverseMat3(this.gl.program.normalMatrix);
-  mat4.transpose(this.gl.program.normalMatrix);
-  for (i in this.programs) {
+  // Inverse transpose of the camera's rotation, kept as is if singular.
+  if (mat4.toInverseMat3(camera, this.inverseCamera3)) {
+    mat3.toMat4(this.inverseCamera3, this.gl.program.normalMatrix);
+    mat4.transpose(this.gl.program.normalMatrix);
+  }
+  for (var i = 0; i < this.programs.length; i++) {
     var program = this.programs[i];
     if (program.id == this.gl.program.id) continue;
     mat4.set(this.gl.program.normalMatrix, program.normalMatrix);
   }
-  for (i in scene.meshes) {
-    this.renderMesh(scene.meshes[i]);
+  if (this.drawListDirty || this.drawListScene !== scene) {
+    this.updateDrawList(scene);
+  }
+  if (this.transformsDirty) this.updateTransforms();
+  if (this.occlusion) this.pollOcclusion();
+  // Set of the view cell the eye is in, -1 for none.
+  var cell = -1;
+  if (this.occlusion || scene.visibility) {
+    mat4.inverse(camera, this.inverseCamera);
+    this.eye[0] = this.inverseCamera[12];
+    this.eye[1] = this.inverseCamera[13];
+    this.eye[2] = this.inverseCamera[14];
+    if (scene.visibility) cell = scene.visibility.lookup(this.eye);
+  }
+  for (var i = 0; i < this.drawList.length; i++) {
+    var mesh = this.drawList[i];
+    if (!mesh.vbo || !mesh.vbo.vertexCount || !mesh.objectMatrix) continue;
+    if (cell >= 0 && mesh.visibilityIndex !== undefined &&
+        !scene.visibility.visible(cell, mesh.visibilityIndex)) {
+      this.count('visibility culled', 1);
+      continue;
+    }
+    if (mesh.textureID && !mesh.texture) {
+      mesh.texture = scene.textures[mesh.textureID];
+      if (!mesh.texture) continue;
+    }
+    // Waiting for its first upload.
+    if (mesh.texture && !mesh.texture.ready) continue;
+    if (mesh.rangeTextureIDs) {
+      if (!mesh.rangeTextures) mesh.rangeTextures = [];
+      for (var r = 0; r < mesh.rangeTextureIDs.length; r++) {
+        if (!mesh.rangeTextures[r] && mesh.rangeTextureIDs[r]) {
+          mesh.rangeTextures[r] = scene.textures[mesh.rangeTextureIDs[r]];
+        }
+      }
+    }
+    if (this.occlusion && mesh.bounds) {
+      this.count('occlusion tests', 1);
+      if (!mesh.occlusionQuery) {
+        mesh.occlusionQuery = this.gl.createQuery();
+        mesh.occluded = false;
+        mesh.queryPending = false;
+      }
+      if (boxContains(mesh.bounds, mesh.objectMatrix, this.eye, OCCLUSION_MARGIN)) {
+        // Its box can't be drawn around the eye.
+        mesh.occluded = false;
+      }
+      else if (!mesh.queryPending) {
+        this.occlusionList[this.occlusionList.length] = mesh;
+      }
+      if (mesh.occluded) {
+        this.count('occlusion culled', 1);
+        continue;
+      }
+    }
+    this.renderMesh(mesh);
+  }
+  if (this.occlusionList.length) this.testOcclusion();
+}
+
+// Starts the main loop. Frames are driven by requestAnimationFrame and a
+// frame is only drawn when something changed: either invalidate() was called
+// (camera/projection stack changes do this automatically) or the frame
+// callback returned true. A frame callback that modifies the camera or
+// meshes in place must return true. With nothing to draw the loop idles
+// until the next invalidate(). 'max fps' optionally caps the frame rate.
+// 'check allocations' logs and counts steady state frames that grew the JS
+// heap, where the browser reports its size.
+BasicRenderer.prototype.run = function(scene, params) {
+  var renderer = this;
+  params = params || {};
+  this.scene = scene;
+  this.frameCallback = params['frame callback'];
+  this.frameCallbackArgs = params['frame callback arguments'];
+  this.checkAllocations = params['check allocations'] ? true : false;
+  this.frameInterval = params['max fps'] ? 1000.0 / params['max fps'] : 0;
+  this.frameHandler = function() { renderer.frame(); };
+  this.lastFrameTime = now();
+  this.running = true;
+  this.invalidate();
+}
+
+BasicRenderer.prototype.stop = function() {
+  this.running = false;
+}
+
+BasicRenderer.prototype.invalidate = function() {
+  this.dirty = true;
+  this.requestFrame();
+}
+
+BasicRenderer.prototype.requestFrame = function() {
+  if (this.framePending || !this.running) return;
+  this.framePending = true;
+  requestFrame(this.frameHandler);
+}
+
+BasicRenderer.prototype.frame = function() {
+  this.framePending = false;
+  if (!this.running) return;
+  var time = now();
+  var elapsed = time - this.lastFrameTime;
+  if (this.frameInterval && elapsed < this.frameInterval - 1) {
+    // Frame rate cap, wait for a later vsync.
+    this.requestFrame();
+    return;
+  }
+  this.lastFrameTime = time;
+  var heap = this.checkAllocations ? usedHeap() : 0;
+  var uploading = this.textureUploads.length || this.uploadedBytes;
+  var animating = false;
+  if (this.frameCallback) {
+    animating = this.frameCallback(elapsed, this.frameCallbackArgs);
+  }
+  var animation = this.scene.animation;
+  if (animation) {
+    animation.advance(elapsed / 1000.0);
+    for (var i = 0; i < animation.meshes.length; i++) {
+      var mesh = animation.meshes[i];
+      if (mesh && mesh.objectMatrix) this.setObjectMatrix(mesh);
+      if (mesh && mesh.skin) mesh.skin.update();
+      if (mesh && mesh.morphs && mesh.vbo) this.updateMorphs(mesh);
+    }
+    animating = true;
+  }
+  if (animating) {
+    this.dirty = true;
+  }
+  if (this.occlusionPending.length && this.pollOcclusion()) {
+    this.dirty = true;
+  }
+  if (this.textureUploads.length) {
+    this.uploadTextures();
+    this.dirty = true;
+  }
+  if (this.dirty) {
+    this.dirty = false;
+    this.render(this.scene);
+  }
+  if (this.checkAllocations && !uploading && !this.drawListDirty) {
+    // Steady state frames should not allocate, loading and uploads may.
+    var allocated = usedHeap() - heap;
+    if (allocated > 0) {
+      this.count('allocating frames', 1);
+      log('frame allocated ' + allocated + ' bytes');
+    }
+  }
+  if (animating || this.textureUploads.length || this.occlusionPending.length) {
+    this.requestFrame();
+  }
+}
+
+// ----------------------------
+// Animation
+// ----------------------------
+
+// Baked object animation as written by the exporter: per track, quantized
+// key values of one translate, rotate or scale channel of a mesh, of one of
+// its morph weights or of one bone matrix element of a skinned mesh's
+// skeleton pose. names are the animated meshes in track order. The tracks
+// index the file's buffer directly and advance() poses the meshes without
+// allocating.
+function Animation(buffer, meshes, names) {
+  var view = new DataView(buffer);
+  this.fps = view.getFloat32(4, true);
+  this.frameCount = view.getUint32(8, true);
+  this.frame = 0;
+  this.meshes = [];
+  for (var i = 0; i < names.length; i++) {
+    this.meshes[i] = meshes[names[i]];
+  }
+  this.tracks = [];
+  var count = view.getUint32(12, true);
+  var at = 16;
+  for (var i = 0; i < count; i++) {
+    var mesh = this.meshes[view.getUint16(at, true)];
+    var channel = view.getUint16(at + 2, true);
+    var keys = view.getUint32(at + 4, true);
+    var padded = (keys * 2 + 3) & ~3;
+    if (mesh) {
+      var target = channel < 3 ? mesh.translate : channel < 6 ? mesh.rotate : mesh.scale;
+      var component = channel % 3;
+      var morphs = mesh.morphWeights ? mesh.morphWeights.length : 0;
+      if (channel >= 9 + morphs) {
+        target = mesh.skeleton["pose"];
+        component = channel - 9 - morphs;
+      }
+      else if (channel >= 9) {
+        target = mesh.morphWeights;
+        component = channel - 9;
+      }
+      this.tracks[this.tracks.length] = {
+        target: target,
+        component: component,
+        min: view.getFloat32(at + 8, true),
+        step: view.getFloat32(at + 12, true),
+        frames: new Uint16Array(buffer, at + 16, keys),
+        values: new Uint16Array(buffer, at + 16 + padded, keys),
+        key: 0
+      };
+    }
+    at += 16 + padded * 2;
   }
 }
 
+// Advances playback by seconds, looping over the frame range, and writes the
+// interpolated channels into the meshes' translate, rotate and scale.
+Animation.prototype.advance = function(seconds) {
+  var length = Math.max(this.frameCount - 1, 1);
+  var frame = (this.frame + seconds * this.fps) % length;
+  this.frame = frame;
+  for (var i = 0; i < this.tracks.length; i++) {
+    var track = this.tracks[i];
+    var frames = track.frames;
+    var last = frames.length - 1;
+    // Playback moves forward, the key is usually unchanged or the next one.
+    if (frame < frames[track.key]) track.key = 0;
+    while (track.key < last && frames[track.key + 1] <= frame) track.key++;
+    var key = track.key;
+    var value = track.values[key];
+    if (key < last) {
+      value += (track.values[key + 1] - value) *
+        (frame - frames[key]) / (frames[key + 1] - frames[key]);
+    }
+    track.target[track.component] = track.min + value * track.step;
+  }
+}
+
+// Sparse morph targets as written by the exporter. Every target lists the
+// vertices it moves, in ascending order, with quantized position and normal
+// deltas. applied holds the weights the VBO currently has blended in.
+function MorphTargets(buffer) {
+  var view = new DataView(buffer);
+  var count = view.getUint16(4, true);
+  var IndexArray = view.getUint16(6, true) == 4 ? Uint32Array : Uint16Array;
+  this.targets = [];
+  this.applied = [];
+  var at = 8;
+  for (var i = 0; i < count; i++) {
+    this.applied[i] = 0;
+    var n = view.getUint32(at, true);
+    var target = {
+      positionStep: view.getFloat32(at + 4, true),
+      normalStep: view.getFloat32(at + 8, true),
+      indices: new IndexArray(buffer, at + 12, n)
+    };
+    at += 12 + ((n * IndexArray.BYTES_PER_ELEMENT + 3) & ~3);
+    target.positions = new Int16Array(buffer, at, n * 3);
+    at += (n * 6 + 3) & ~3;
+    target.normals = new Int8Array(buffer, at, n * 3);
+    at += (n * 3 + 3) & ~3;
+    this.targets[i] = target;
+  }
+}
+
+// Bone palette of a skinned mesh. world holds the posed bone matrices in the
+// mesh's space and rows the skinning matrices uploaded to the shader, both as
+// the top three rows of each bone's matrix like the skeleton's pose.
+function Skin(skeleton) {
+  this.parents = skeleton["parents"];
+  this.pose = skeleton["pose"];
+  this.inverseBind = skeleton["inverse bind"];
+  this.world = new Float32Array(this.pose.length);
+  this.rows = new Float32Array(this.pose.length);
+}
+
+// Poses the bones from the skeleton's pose, parents come before children.
+Skin.prototype.update = function() {
+  for (var b = 0; b < this.parents.length; b++) {
+    var parent = this.parents[b];
+    if (parent < 0) {
+      for (var i = 0; i < 12; i++) this.world[b * 12 + i] = this.pose[b * 12 + i];
+    }
+    else {
+      multiplyAffine(this.world, parent * 12, this.pose, b * 12, this.world, b * 12);
+    }
+    multiplyAffine(this.world, b * 12, this.inverseBind, b * 12, this.rows, b * 12);
+  }
+}
+
+// Multiplies the affine matrices given by their top three rows in a and b at
+// offsets ai and bi, writing the rows of the product to out at oi.
+function multiplyAffine(a, ai, b, bi, out, oi) {
+  for (var r = ai; r < ai + 12; r += 4) {
+    var a0 = a[r], a1 = a[r + 1], a2 = a[r + 2], a3 = a[r + 3];
+    out[oi] = a0 * b[bi] + a1 * b[bi + 4] + a2 * b[bi + 8];
+    out[oi + 1] = a0 * b[bi + 1] + a1 * b[bi + 5] + a2 * b[bi + 9];
+    out[oi + 2] = a0 * b[bi + 2] + a1 * b[bi + 6] + a2 * b[bi + 10];
+    out[oi + 3] = a0 * b[bi + 3] + a1 * b[bi + 7] + a2 * b[bi + 11] + a3;
+    oi += 4;
+  }
+}
+
+// ----------------------------
+// Visibility
+// ----------------------------
+
+// Potentially visible sets as written by the exporter: a grid of view cells
+// over the scene, each with a bitset of the meshes that may be seen from
+// it. names are the meshes in bit order, meshes not named are always drawn.
+function VisibilitySets(buffer, meshes, names) {
+  var view = new DataView(buffer);
+  var count = view.getUint32(4, true);
+  var rows = view.getUint32(8, true);
+  this.origin = [
+    view.getFloat32(12, true), view.getFloat32(16, true), view.getFloat32(20, true)
+  ];
+  this.cellSize = view.getFloat32(24, true);
+  this.dims = [
+    view.getUint16(28, true), view.getUint16(30, true), view.getUint16(32, true)
+  ];
+  var cells = this.dims[0] * this.dims[1] * this.dims[2];
+  this.cells = new Uint16Array(buffer, 36, cells);
+  this.stride = (count + 7) >> 3;
+  this.rows = new Uint8Array(buffer, 36 + ((cells * 2 + 3) & ~3), rows * this.stride);
+  for (var i = 0; i < names.length; i++) {
+    if (meshes[names[i]]) meshes[names[i]].visibilityIndex = i;
+  }
+}
+
+// Byte offset of the set of the cell containing point, -1 outside the grid
+// and for cells without a set.
+VisibilitySets.prototype.lookup = function(point) {
+  var index = 0, scale = 1;
+  for (var i = 0; i < 3; i++) {
+    var c = Math.floor((point[i] - this.origin[i]) / this.cellSize);
+    if (c < 0 || c >= this.dims[i]) return -1;
+    index += c * scale;
+    scale *= this.dims[i];
+  }
+  var row = this.cells[index];
+  if (row == 0xffff) return -1;
+  return row * this.stride;
+}
+
+VisibilitySets.prototype.visible = function(cell, index) {
+  return (this.rows[cell + (index >> 3)] & (1 << (index & 7))) != 0;
+}
+
 function StandardVBO() {
   this.id = ++last_vbo_id;
+  this.ranges = null;
+  // Frequently updated VBOs get DYNAMIC_DRAW buffers, see updateVBO().
+  this.dynamic = false;
+  // Progressive VBOs waiting for levels, see streamVBO().
+  this.streaming = false;
+  // Changed spans { first, end } and the arrays last uploaded, by name.
+  this.dirty = {};
+  this.uploaded = {};
+}
+
+// Marks elements first to end of one of the arrays ('vertices', 'normals',
+// 'texcoords', 'bones', 'weights' or 'indices') as changed, updateVBO() then
+// only uploads the spans that changed.
+StandardVBO.prototype.markDirty = function(name, first, end) {
+  var span = this.dirty[name];
+  if (!span) {
+    this.dirty[name] = { first: first, end: end };
+  }
+  else if (span.first >= span.end) {
+    span.first = first;
+    span.end = end;
+  }
+  else {
+    span.first = Math.min(span.first, first);
+    span.end = Math.max(span.end, end);
+  }
+}
+
+// Draw ranges { first, count } from their index counts, the ranges follow
+// each other in the index buffer.
+StandardVBO.prototype.setRanges = function(counts) {
+  if (!this.ranges) this.ranges = [];
+  var first = 0;
+  for (var i = 0; i < counts.length; i++) {
+    if (!this.ranges[i]) this.ranges[i] = { first: 0, count: 0 };
+    this.ranges[i].first = first;
+    this.ranges[i].count = counts[i];
+    first += counts[i];
+  }
 }
 
 StandardVBO.prototype.bind = function(gl) {
+  if (this.vao) {
+    this.vertexArrays.bind(this.vao);
+    return true;
+  }
+  return this.setupAttributes(gl);
+}
+
+StandardVBO.prototype.setupAttributes = function(gl) {
   gl.bindBuffer(gl.ARRAY_BUFFER, this.vertexObject);
   gl.vertexAttribPointer(2, 3, gl.FLOAT, false, 0, 0);
   gl.bindBuffer(gl.ARRAY_BUFFER, this.normalsObject);
   gl.vertexAttribPointer(0, 3, gl.FLOAT, false, 0, 0);
   gl.bindBuffer(gl.ARRAY_BUFFER, this.texcoordsObject);
   gl.vertexAttribPointer(1, 2, gl.FLOAT, false, 0, 0);
+  if (this.bonesObject) {
+    gl.enableVertexAttribArray(SKIN_ATTRIBUTE);
+    gl.enableVertexAttribArray(SKIN_ATTRIBUTE + 1);
+    gl.bindBuffer(gl.ARRAY_BUFFER, this.bonesObject);
+    gl.vertexAttribPointer(SKIN_ATTRIBUTE, 4, gl.UNSIGNED_BYTE, false, 0, 0);
+    gl.bindBuffer(gl.ARRAY_BUFFER, this.weightsObject);
+    gl.vertexAttribPointer(SKIN_ATTRIBUTE + 1, 4, gl.UNSIGNED_BYTE, true, 0, 0);
+  }
+  else if (!this.vao) {
+    // Without vertex array objects the enabled state is global.
+    gl.disableVertexAttribArray(SKIN_ATTRIBUTE);
+    gl.disableVertexAttribArray(SKIN_ATTRIBUTE + 1);
+  }
   gl.bindBuffer(gl.ELEMENT_ARRAY_BUFFER, this.indicesObject);
   return true;
 }
 
-BasicRenderer.prototype._rewriteMeshData = function(data, matrix) {
-  var newdata = [];
-  var numvertices = data.length / 3;
-  for (var i = 0; i < numvertices; i++) {
-    var index = i * 3;
-    var vector = vec3.create([data[index+0], data[index+1], data[index+2]]);
-    mat4.multiplyVec3(matrix, vector);
-    newdata[newdata.length] = vector[0];
-    newdata[newdata.length] = vector[1];
-    newdata[newdata.length] = vector[2];
+// Writes the positions in data transformed by matrix to dest at offset.
+BasicRenderer.prototype._rewriteMeshData = function(data, matrix, dest, offset) {
+  var m = matrix;
+  for (var i = 0, n = data.length; i < n; i += 3) {
+    var x = data[i], y = data[i+1], z = data[i+2];
+    dest[offset+i+0] = m[0]*x + m[4]*y + m[8]*z + m[12];
+    dest[offset+i+1] = m[1]*x + m[5]*y + m[9]*z + m[13];
+    dest[offset+i+2] = m[2]*x + m[6]*y + m[10]*z + m[14];
+  }
+}
+
+// Writes the normals in data transformed by the transpose of inverse (a
+// mat3 from mat4.toInverseMat3) to dest at offset.
+BasicRenderer.prototype._rewriteNormals = function(data, inverse, dest, offset) {
+  var m = inverse;
+  for (var i = 0, n = data.length; i < n; i += 3) {
+    var x = data[i], y = data[i+1], z = data[i+2];
+    var nx = m[0]*x + m[1]*y + m[2]*z;
+    var ny = m[3]*x + m[4]*y + m[5]*z;
+    var nz = m[6]*x + m[7]*y + m[8]*z;
+    var len = Math.sqrt(nx*nx + ny*ny + nz*nz);
+    if (len) len = 1 / len;
+    dest[offset+i+0] = nx * len;
+    dest[offset+i+1] = ny * len;
+    dest[offset+i+2] = nz * len;
   }
-  return newdata;
 }
 
-BasicRenderer.prototype._rewriteIndices = function(data, base) {
-  var newdata = [];
-  for (var i in data) {
-    newdata[i] = data[i] + base;
+BasicRenderer.prototype._rewriteIndices = function(data, base, dest, offset) {
+  for (var i = 0, n = data.length; i < n; i++) {
+    dest[offset+i] = data[i] + base;
   }
-  return newdata;
 }
 
+// Merges the meshes named in the meshlist array into one mesh in world
+// space. The output is sized up front and built in typed arrays, indices are
+// 32 bit when more than 65536 vertices are combined. Returns null if that
+// would need 32 bit indices and OES_element_index_uint is unavailable.
+// Instanced, skinned, morphing and parented meshes, meshes with draw ranges
+// and progressive meshes still streaming are left alone.
 BasicRenderer.prototype.combineMeshes = function(name, meshes, meshlist) {
+  var list = [];
+  var vertexCount = 0;
+  var indexCount = 0;
+  for (var i = 0; i < meshlist.length; i++) {
+    var meshname = meshlist[i];
+    if (!meshname) continue;
+    var mesh = meshes[meshname];
+    if (!mesh || mesh.instances || mesh.skeleton || mesh.morphWeights ||
+        mesh.parent || mesh.rangeTextureIDs || mesh.vbo.streaming) continue;
+    list[list.length] = meshname;
+    vertexCount += mesh.vbo.vertexData.length / 3;
+    indexCount += mesh.vbo.indicesData.length;
+  }
+  var IndexArray = Uint16Array;
+  if (vertexCount > 65536) {
+    if (!this.uintIndices) {
+      log('combineMeshes: ' + name + ' needs 32 bit indices, not supported');
+      return null;
+    }
+    IndexArray = Uint32Array;
+  }
   var combinedmesh = new Mesh({
     "translate": [0, 0, 0],
     "rotate": [0, 0, 0],
-    "scale": [1, 1, 1],
+    "scale": [1, 1, 1]
   });
-  var vertexData = [];
-  var texcoordsData = [];
-  var normalsData = [];
-  var indicesData = [];
+  var vertexData = new Float32Array(vertexCount * 3);
+  var normalsData = new Float32Array(vertexCount * 3);
+  var texcoordsData = new Float32Array(vertexCount * 2);
+  var indicesData = new IndexArray(indexCount);
+  var inverse = mat3.create();
+  var vertexBase = 0;
   var indexBase = 0;
-  for (i in meshlist) {
-    var meshname = meshlist[i];
-    if (!meshname) continue;
-    var mesh = meshes[meshname];
-    if (!mesh) continue;
-    vertexData = vertexData.concat(this._rewriteMeshData(mesh.vbo.vertexData, mesh.objectMatrix));
-    texcoordsData = texcoordsData.concat(mesh.vbo.texcoordsData);
-    normalsData = normalsData.concat(mesh.vbo.normalsData);
-    indicesData = indicesData.concat(this._rewriteIndices(mesh.vbo.indicesData, indexBase));
+  for (var i = 0; i < list.length; i++) {
+    var mesh = meshes[list[i]];
+    var vbo = mesh.vbo;
+    this._rewriteMeshData(vbo.vertexData, mesh.objectMatrix, vertexData, vertexBase * 3);
+    if (!mat4.toInverseMat3(mesh.objectMatrix, inverse)) {
+      mat3.identity(inverse);
+    }
+    this._rewriteNormals(vbo.normalsData, inverse, normalsData, vertexBase * 3);
+    if (vbo.texcoordsData) {
+      texcoordsData.set(vbo.texcoordsData, vertexBase * 2);
+    }
+    this._rewriteIndices(vbo.indicesData, vertexBase, indicesData, indexBase);
     combinedmesh.textureID = mesh.textureID;
     combinedmesh.texture = mesh.texture;
-    indexBase += mesh.vbo.vertexData.length / 3;
-    delete meshes[meshname];
+    vertexBase += vbo.vertexData.length / 3;
+    indexBase += vbo.indicesData.length;
+    delete meshes[list[i]];
   }
-  data = {
+  var data = {
     "vertices": vertexData,
     "texcoords": texcoordsData,
     "normals": normalsData,
@@ -2509,6 +5943,7 @@ BasicRenderer.prototype.combineMeshes = function(name, meshes, meshlist) {
   combinedmesh.vbo = this.standardVBO(data, [this]);
   this.setObjectMatrix(combinedmesh);
   meshes[name] = combinedmesh;
+  this.drawListDirty = true;
   return combinedmesh;
 }
 """
@@ -2591,15 +6026,49 @@ HTML = """<html>
       attribute vec3 vNormal;
       attribute vec2 vTexCoord;
       attribute vec4 vPosition;
+      attribute mat4 vInstanceMatrix;
       varying float v_Dot;
       varying vec2 v_texCoord;
       void main() {
-        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vPosition;
+        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vInstanceMatrix * vPosition;
         v_texCoord = vTexCoord.st;
         vec4 transNormal = u_normalMatrix * vec4(vNormal, 1);
         v_Dot = max(dot(transNormal.xyz, lightDir), 0.65);
       }
     </script>
+    <script id='vprog-skinned' type='x-shader/x-vertex'>
+      uniform mat4 u_modelViewMatrix;
+      uniform mat4 u_objectMatrix;
+      uniform mat4 u_normalMatrix;
+      uniform mat4 u_projMatrix;
+      uniform vec3 lightDir;
+      uniform vec4 u_bones[96];
+      attribute vec3 vNormal;
+      attribute vec2 vTexCoord;
+      attribute vec4 vPosition;
+      attribute vec4 vBoneIndices;
+      attribute vec4 vBoneWeights;
+      varying float v_Dot;
+      varying vec2 v_texCoord;
+      void main() {
+        // Vertices without weights stay in place.
+        float rest = 1.0 - dot(vBoneWeights, vec4(1.0));
+        vec3 position = rest * vPosition.xyz;
+        vec3 normal = rest * vNormal;
+        for (int i = 0; i < 4; i++) {
+          int bone = int(vBoneIndices[i]) * 3;
+          vec4 x = u_bones[bone];
+          vec4 y = u_bones[bone + 1];
+          vec4 z = u_bones[bone + 2];
+          position += vBoneWeights[i] * vec3(dot(x, vPosition), dot(y, vPosition), dot(z, vPosition));
+          normal += vBoneWeights[i] * vec3(dot(x.xyz, vNormal), dot(y.xyz, vNormal), dot(z.xyz, vNormal));
+        }
+        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vec4(position, 1.0);
+        v_texCoord = vTexCoord.st;
+        vec4 transNormal = u_normalMatrix * vec4(normal, 1);
+        v_Dot = max(dot(transNormal.xyz, lightDir), 0.65);
+      }
+    </script>
     <script id='fprog' type='x-shader/x-fragment'>
       #ifdef GL_ES
         precision mediump float;
@@ -2614,6 +6083,101 @@ HTML = """<html>
         gl_FragColor = vec4(color.xyz, 1.0);
       }
     </script>
+    <script id='vprog2' type='x-shader/x-vertex'>
+      #version 300 es
+      layout(std140) uniform Frame {
+        mat4 u_projMatrix;
+        mat4 u_modelViewMatrix;
+        mat4 u_normalMatrix;
+      };
+      uniform mat4 u_objectMatrix;
+      uniform vec3 lightDir;
+      in vec3 vNormal;
+      in vec2 vTexCoord;
+      in vec4 vPosition;
+      in mat4 vInstanceMatrix;
+      out float v_Dot;
+      out vec2 v_texCoord;
+      void main() {
+        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vInstanceMatrix * vPosition;
+        v_texCoord = vTexCoord.st;
+        vec4 transNormal = u_normalMatrix * vec4(vNormal, 1);
+        v_Dot = max(dot(transNormal.xyz, lightDir), 0.65);
+      }
+    </script>
+    <script id='vprog2-skinned' type='x-shader/x-vertex'>
+      #version 300 es
+      layout(std140) uniform Frame {
+        mat4 u_projMatrix;
+        mat4 u_modelViewMatrix;
+        mat4 u_normalMatrix;
+      };
+      uniform mat4 u_objectMatrix;
+      uniform vec3 lightDir;
+      uniform vec4 u_bones[96];
+      in vec3 vNormal;
+      in vec2 vTexCoord;
+      in vec4 vPosition;
+      in vec4 vBoneIndices;
+      in vec4 vBoneWeights;
+      out float v_Dot;
+      out vec2 v_texCoord;
+      void main() {
+        // Vertices without weights stay in place.
+        float rest = 1.0 - dot(vBoneWeights, vec4(1.0));
+        vec3 position = rest * vPosition.xyz;
+        vec3 normal = rest * vNormal;
+        for (int i = 0; i < 4; i++) {
+          int bone = int(vBoneIndices[i]) * 3;
+          vec4 x = u_bones[bone];
+          vec4 y = u_bones[bone + 1];
+          vec4 z = u_bones[bone + 2];
+          position += vBoneWeights[i] * vec3(dot(x, vPosition), dot(y, vPosition), dot(z, vPosition));
+          normal += vBoneWeights[i] * vec3(dot(x.xyz, vNormal), dot(y.xyz, vNormal), dot(z.xyz, vNormal));
+        }
+        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vec4(position, 1.0);
+        v_texCoord = vTexCoord.st;
+        vec4 transNormal = u_normalMatrix * vec4(normal, 1);
+        v_Dot = max(dot(transNormal.xyz, lightDir), 0.65);
+      }
+    </script>
+    <script id='fprog2' type='x-shader/x-fragment'>
+      #version 300 es
+      precision mediump float;
+      uniform sampler2D sampler2d;
+      in float v_Dot;
+      in vec2 v_texCoord;
+      out vec4 fragColor;
+      void main() {
+        vec2 texCoord = vec2(v_texCoord.s, 1.0 - v_texCoord.t);
+        vec4 color = texture(sampler2d, texCoord);
+        fragColor = vec4(color.xyz, 1.0);
+      }
+    </script>
+    <script id='vprog2-box' type='x-shader/x-vertex'>
+      #version 300 es
+      layout(std140) uniform Frame {
+        mat4 u_projMatrix;
+        mat4 u_modelViewMatrix;
+        mat4 u_normalMatrix;
+      };
+      uniform mat4 u_objectMatrix;
+      uniform vec3 u_boxMin;
+      uniform vec3 u_boxSize;
+      in vec4 vPosition;
+      void main() {
+        vec3 position = u_boxMin + vPosition.xyz * u_boxSize;
+        gl_Position = u_projMatrix * u_modelViewMatrix * u_objectMatrix * vec4(position, 1.0);
+      }
+    </script>
+    <script id='fprog2-box' type='x-shader/x-fragment'>
+      #version 300 es
+      precision mediump float;
+      out vec4 fragColor;
+      void main() {
+        fragColor = vec4(1.0);
+      }
+    </script>
     <script type='text/javascript'>
 
       $(document).ready(function() {
@@ -2623,6 +6187,7 @@ HTML = """<html>
           'canvas id': 'canvas3d',
           'clear depth': 10000,
           'clear color': [ 0.97, 0.97, 0.97, 1 ],
+          'texture upload budget': 4,
           'vertex program id': 'vprog',
           'fragment program id': 'fprog',
           'light variable': 'lightDir',
@@ -2631,7 +6196,19 @@ HTML = """<html>
           'object matrix variable': 'u_objectMatrix',
           'modelview matrix variable': 'u_modelViewMatrix',
           'projection matrix variable': 'u_projMatrix',
-          'vertex attribute names': [ 'vNormal', 'vTexCoord', 'vPosition' ],
+          'vertex attribute names': [ 'vNormal', 'vTexCoord', 'vPosition', 'vInstanceMatrix' ],
+          'skinning vertex program id': 'vprog-skinned',
+          'skinning attribute names': [ 'vBoneIndices', 'vBoneWeights' ],
+          'bones variable': 'u_bones',
+          'webgl2 vertex program id': 'vprog2',
+          'webgl2 skinning vertex program id': 'vprog2-skinned',
+          'webgl2 fragment program id': 'fprog2',
+          'frame block name': 'Frame',
+          'occlusion culling': true,
+          'occlusion vertex program id': 'vprog2-box',
+          'occlusion fragment program id': 'fprog2-box',
+          'box min variable': 'u_boxMin',
+          'box size variable': 'u_boxSize',
         });
 
         // Check if this is a WebGL capable browser.
@@ -2644,9 +6221,15 @@ HTML = """<html>
         // Load scene.
         var scene = new ${{SCENECLASSNAME}} ({
           'texture callback': renderer.standardTexture,
-          'texture arguments': [ renderer.gl ],
+          'texture arguments': [ renderer.gl, renderer ],
           'vbo callback': renderer.standardVBO,
-          'vbo arguments': [ renderer ]
+          'vbo arguments': [ renderer ],
+          'stream callback': renderer.streamVBO,
+          'load callback': function(scene, name) {
+            // Draw meshes as they arrive.
+            if (name) renderer.prepareMesh(scene, scene.meshes[name]);
+            renderer.invalidate();
+          }
         });
 
         // Loader object loads images, JS objects, and reports loading status.
@@ -2654,23 +6237,32 @@ HTML = """<html>
           'expander': '#loadbox .progress .bar',
           'percent label': false, //'#loadbox .progress .label .percent',
           'itemcount label': '#loadbox .progress .label .items',
+          'max requests': 6,
+          'worker script': 'js/webgl-jso-meshworker.js',
+          'texture formats': renderer.textureFormats,
+          'log timings': true,
           'complete callback': function() {
             $('#loadbox').css('display', 'none');
-            var canvas = $('#canvas3d');
-            $('#canvas-wrapper').css('display', 'block');
-            canvas.css('display', 'block');
-            renderer.prepareMeshes(scene);
-            renderer.reshape(canvas.width(), canvas.height());
-            setInterval(function() {
-              // Main loop.
-	      mat4.rotate(renderer.camera(), 0.5 * Math.PI / 180.0, [0,0,1]);
-              renderer.render(scene);
-            }, 25);
           }
         });
 
-        // Everything's ready, display the loading box and load.
+        // Everything's ready, display the loading box and the canvas, the
+        // scene fills in as it loads.
         $('#loadbox').css('display', 'block');
+        var canvas = $('#canvas3d');
+        $('#canvas-wrapper').css('display', 'block');
+        canvas.css('display', 'block');
+        renderer.reshape(canvas.width(), canvas.height());
+        var axis = [0, 0, 1];
+        renderer.run(scene, {
+          'max fps': 0,
+          'check allocations': false,
+          'frame callback': function(elapsed) {
+            // Main loop, spins the camera 20 degrees per second.
+            mat4.rotate(renderer.camera(), elapsed * 0.02 * Math.PI / 180.0, axis);
+            return true;
+          }
+        });
         scene.load(loader);
 
       });
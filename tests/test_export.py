@@ -0,0 +1,190 @@
+#
+# Exporter tests, runnable outside Blender: the bpy and mathutils modules
+# are replaced by the minimal fakes below before the exporter is imported.
+#
+
+import os, struct, sys, types, unittest
+
+class Vector(list):
+  def __add__(self, o): return Vector([a + b for a, b in zip(self, o)])
+  def __sub__(self, o): return Vector([a - b for a, b in zip(self, o)])
+  def __mul__(self, k): return Vector([a * k for a in self])
+  @property
+  def length(self): return sum([a * a for a in self]) ** 0.5
+
+class Matrix(list):
+  def __init__(self, rows=None):
+    list.__init__(self, rows or [[float(i == j) for j in range(4)] for i in range(4)])
+  def __mul__(self, o):
+    v = list(o) + [1.0]
+    return Vector([sum([self[i][k] * v[k] for k in range(4)]) for i in range(3)])
+  def determinant(self):
+    m = self
+    return (
+      m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1]) -
+      m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) +
+      m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0])
+    )
+
+class Namespace(object):
+  def __init__(self, **kw): self.__dict__.update(kw)
+
+def _property(**kw): return kw
+
+class _Meshes(list):
+  def remove(self, mesh): self.removed.append(mesh)
+
+mathutils = types.ModuleType('mathutils')
+mathutils.Vector, mathutils.Matrix = Vector, Matrix
+mathutils.__all__ = ['Vector', 'Matrix']
+bpy = types.ModuleType('bpy')
+bpy.props = types.ModuleType('bpy.props')
+for name in ('StringProperty', 'BoolProperty', 'IntProperty', 'FloatProperty'):
+  setattr(bpy.props, name, _property)
+bpy.props.__all__ = ['StringProperty', 'BoolProperty', 'IntProperty', 'FloatProperty']
+bpy.types = Namespace(Operator=object)
+bpy.data = Namespace(meshes=_Meshes(), objects=[], images=[], filepath='')
+bpy.context = Namespace(scene=Namespace(update=lambda: None))
+sys.modules.setdefault('mathutils', mathutils)
+sys.modules.setdefault('bpy', bpy)
+sys.modules.setdefault('bpy.props', bpy.props)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import io_export_yawgle as exporter
+
+def strip_MESH(name, count, offset=0.0):
+  # Mesh of count vertices along x, with a triangle per three vertices.
+  vertices = [
+    Namespace(co=Vector([offset + i, float(i % 3), 0.0]), normal=Vector([0.0, 0.0, 1.0]))
+    for i in range(count)
+  ]
+  faces = [
+    Namespace(vertices=[i, i + 1, i + 2], index=n)
+    for n, i in enumerate(range(0, count - 2, 3))
+  ]
+  return Namespace(
+    name=name, vertices=vertices, faces=faces, uv_textures=[],
+    transform=lambda matrix: None, calc_normals=lambda: None
+  )
+
+def mesh_OBJECT(name, count, offset=0.0):
+  return Namespace(
+    name=name, matrix_world=Matrix(),
+    create_mesh=lambda scene, apply, settings: strip_MESH(name, count, offset)
+  )
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    bpy.data.meshes.removed = []
+
+  def test_batches_stay_below_limit(self):
+    members = []
+    objs = [mesh_OBJECT('a', 30), mesh_OBJECT('b', 30, 100.0), mesh_OBJECT('c', 30, 200.0)]
+    batches = exporter._batch_MESHES(objs, limit=64, members=members)
+    self.assertEqual([[obj.name for obj in m] for m in members], [['a', 'b'], ['c']])
+    for data, indices, ranges in batches:
+      self.assertTrue(len(data) <= 64)
+      self.assertTrue(max(indices) < len(data))
+
+  def test_object_over_limit_is_left_out(self):
+    members = []
+    objs = [mesh_OBJECT('small', 30), mesh_OBJECT('big', 65538, 100.0)]
+    batches = exporter._batch_MESHES(objs, members=members)
+    self.assertEqual([[obj.name for obj in m] for m in members], [['small']])
+    self.assertEqual(len(batches), 1)
+    self.assertTrue(max(batches[0][1]) <= 65535)
+
+class MorphTargetTest(unittest.TestCase):
+
+  def setUp(self):
+    bpy.data.meshes.removed = []
+
+  def keyed_MESH(self, keys, extra):
+    # Vertices moved by the key values, extra vertices while the first key
+    # is fully applied, as a topology changing modifier might add.
+    def evaluate():
+      count = 3 + (extra if keys[0].value == 1.0 else 0)
+      mesh = strip_MESH('keyed', count)
+      for v in mesh.vertices:
+        v.co = v.co + Vector([0.0, 0.0, sum([key.value for key in keys])])
+      return mesh
+    return evaluate
+
+  def test_targets(self):
+    keys = [Namespace(value=0.25), Namespace(value=0.5)]
+    basis, targets = exporter._morph_TARGETS(self.keyed_MESH(keys, 0), keys)
+    self.assertEqual([v.co[2] for v in basis.vertices], [0.0] * 3)
+    self.assertEqual([[p[2] for p in t[0]] for t in targets], [[1.0] * 3] * 2)
+    self.assertEqual([key.value for key in keys], [0.25, 0.5])
+
+  def test_mismatched_vertices_keep_pose(self):
+    keys = [Namespace(value=0.25), Namespace(value=0.5)]
+    mesh, targets = exporter._morph_TARGETS(self.keyed_MESH(keys, 3), keys)
+    self.assertEqual(targets, None)
+    self.assertEqual([v.co[2] for v in mesh.vertices], [0.75] * 3)
+    self.assertEqual([key.value for key in keys], [0.25, 0.5])
+
+class SkinTest(unittest.TestCase):
+
+  def setUp(self):
+    bpy.data.meshes.removed = []
+
+  def test_unweighted_vertices_stay_in_place(self):
+    mesh = strip_MESH('skinned', 3)
+    mesh.vertices[0].groups = [Namespace(group=0, weight=0.5), Namespace(group=1, weight=0.5)]
+    mesh.vertices[1].groups = []
+    mesh.vertices[2].groups = [Namespace(group=1, weight=0.0)]
+    obj = Namespace(
+      create_mesh=lambda scene, apply, settings: mesh,
+      vertex_groups=[Namespace(name='root'), Namespace(name='arm')]
+    )
+    armature = Namespace(data=Namespace(pose_position='POSE'))
+    bones = [Namespace(name='root'), Namespace(name='arm')]
+    mesh, weights = exporter._skin_MESH(obj, armature, bones)
+    self.assertEqual(sum(weights[0][4:]), 255)
+    self.assertEqual(weights[1], [0] * 8)
+    self.assertEqual(weights[2], [0] * 8)
+    self.assertEqual(armature.data.pose_position, 'POSE')
+
+  def test_data_key_depends_on_armature(self):
+    data = Namespace(name='Body')
+    skins = {
+      'a': (Namespace(name='Rig'), []), 'b': (Namespace(name='Rig.001'), [])
+    }
+    keys = [
+      exporter._data_KEY(Namespace(name=name, data=data), skins)
+      for name in ('a', 'b', 'c')
+    ]
+    self.assertEqual(keys, ['Body__Rig', 'Body__Rig.001', 'Body'])
+
+class AnimationTest(unittest.TestCase):
+
+  def test_reduce_keys(self):
+    values = [0.0, 1.0, 2.0, 3.0, 2.0, 1.0]
+    self.assertEqual(exporter._reduce_KEYS(values, 0.001), [0, 3, 5])
+    self.assertEqual(exporter._reduce_KEYS([0.0, 0.0004, 0.0], 0.0005), [0, 2])
+
+  def test_binary_animation(self):
+    data = exporter._binary_ANIMATION([[[0.0, 1.0, 2.0, 3.0]]], 24.0)
+    magic, fps, frames, count = struct.unpack_from('<4sfII', data)
+    self.assertEqual((magic, fps, frames, count), (b'YAN1', 24.0, 4, 1))
+    o, c, keys, lo, step = struct.unpack_from('<HHIff', data, 16)
+    self.assertEqual((o, c, keys, lo), (0, 0, 2, 0.0))
+    self.assertEqual(struct.unpack_from('<2H2H', data, 32), (0, 3, 0, 65535))
+    self.assertAlmostEqual(65535 * step, 3.0, 5)
+
+  def test_unchanged_channels_are_left_out(self):
+    self.assertEqual(exporter._binary_ANIMATION([[[1.0] * 4]], 24.0), None)
+
+  def test_keys_within_tolerance_make_a_constant_track(self):
+    # Keys 0, 2 and 4 are kept and all equal, only the samples between
+    # them differ.
+    values = [0.0, 0.0004, 0.0, -0.0004, 0.0]
+    data = exporter._binary_ANIMATION([[values]], 24.0)
+    o, c, keys, lo, step = struct.unpack_from('<HHIff', data, 16)
+    self.assertEqual((keys, lo), (3, 0.0))
+    self.assertEqual(struct.unpack_from('<3H2x3H', data, 32), (0, 2, 4, 0, 0, 0))
+
+if __name__ == '__main__':
+  unittest.main()